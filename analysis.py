@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Analysing a layout in the background while it's being edited.
+
+Whether the layout is good, which runs cross or come too close, and the
+energy of the runs (see optimize.LayoutEnergy) can all take long enough on
+a big layout to make dragging a junction stutter if they're worked out in
+the matplotlib event loop. Instead the editor hands them, along with a
+snapshot of the numbers they need, to an AnalysisWorker, which works
+through them on one background thread. Submitting a job cancels the one
+of the same kind still waiting, so the worker is never more than one job
+of each kind behind, and the editor doesn't send any more while the last
+ones are running: the edits made meanwhile all go in the next job once
+they finish. The crossings are kept in a clearance.ClearanceIndex that
+each job only updates for the runs of the junctions that moved. A timer in
+the editor collects the finished results and colours the runs to match:
+
+    - runs a train can get trapped on (bad layouts only): TRAP_COLOR
+    - runs crossing another run: CROSSING_COLOR
+    - runs closer than the clearance to another run: CLOSE_COLOR
+
+Only the latest job of each kind ever has its result handed back, results
+of jobs that were replaced while running are thrown away.
+
+@author: Dan
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from topology import check_table
+
+# kinds of analysis
+TOPOLOGY = 'topology'
+CROSSINGS = 'crossings'
+ENERGY = 'energy'
+
+RUN_COLOR = 'b'
+TRAP_COLOR = 'orange'
+CLOSE_COLOR = 'm'
+CROSSING_COLOR = 'r'
+
+
+def trap_runs(table, runPorts):
+    """(good, trapped) where trapped is a bool array, True for each run a
+    train can get stuck going round in a bad layout, see
+    topology.check_table"""
+    good, trap = check_table(table)
+    trapped = np.zeros(len(runPorts), dtype=bool)
+    if trap:
+        ports = np.zeros(len(table), dtype=bool)
+        ports[np.asarray(trap) // 2] = True
+        trapped = ports[runPorts].any(axis=1)
+    return good, trapped
+
+
+def update_clearances(index, runs=None):
+    """Re-index runs (all of them if None) of a clearance.ClearanceIndex
+    from their curves as they are, and return {(i, j): shortest distance}
+    for the pairs of runs closer than its clearance that don't share a
+    junction"""
+    if runs is None:
+        index.rebuild()
+    else:
+        index.updateRuns(runs)
+    return {(i, j): d for (i, j), d in index.pairs.items() if not index.touching(i, j)}
+
+
+def layout_energy(energy, loc, theta, swapped):
+    """Total energy and energy of each curve, see optimize.LayoutEnergy"""
+    E, perCurve, _, _ = energy(loc, theta, swapped, gradient=False)
+    return E, perCurve
+
+
+class AnalysisWorker():
+    # runs analysis jobs on one background thread, keeping only the latest
+    # job of each kind, see the module docstring
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='analysis')
+        self.jobs = {}  # kind -> Future of its latest job
+
+    def submit(self, kind, function, *args):
+        """Run function(*args) in the background, replacing any job of this
+        kind that hasn't finished. The arguments shouldn't be changed
+        afterwards, pass copies of anything that will be."""
+        old = self.jobs.get(kind)
+        if old is not None:
+            old.cancel()  # does nothing if it has already started
+        self.jobs[kind] = self.executor.submit(function, *args)
+
+    def results(self):
+        """{kind: result} of the latest jobs that have finished since the
+        last call, each result is handed back once"""
+        done = {}
+        for kind, future in list(self.jobs.items()):
+            if future.done():
+                del self.jobs[kind]
+                done[kind] = future.result()
+        return done
+
+    def busy(self):
+        return bool(self.jobs)
+
+    def running(self, kind):
+        """True if the latest job of this kind hasn't finished"""
+        future = self.jobs.get(kind)
+        return future is not None and not future.done()
+
+    def wait(self, timeout=None):
+        """Block until the current jobs have finished, and return their
+        results like results()"""
+        wait(list(self.jobs.values()), timeout)
+        return self.results()
+
+    def close(self):
+        for future in self.jobs.values():
+            future.cancel()
+        self.jobs = {}
+        self.executor.shutdown(wait=False)
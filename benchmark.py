@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Timings of the main Track code paths on layouts of growing size.
+
+Two kinds of layout are made for each size, both from a fixed seed so runs
+can be compared between versions:
+
+    - random: every port paired up with another at random, almost always
+      bad. traverse isn't timed on these, it can wander round a trap that
+      has choices in it forever.
+    - good: the two reversing loop layout from the README, with reversing
+      loops spliced in at random until it has enough junctions. Adding a
+      reversing loop never makes a good layout bad, so traverse has to
+      go all the way round these. Its random walk takes wildly varying and
+      fast growing time, so it is only timed up to --traverse-limit
+      junctions.
+
+Everything runs headless on the Agg backend. Results are written as JSON,
+and an earlier results file can be given with --compare to see what got
+faster or slower.
+
+    python benchmark.py --sizes 10 100 1000 10000 --output bench_output.json
+
+@author: Dan
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+from repair import add_reversing_loop
+from sampling import random_tables
+from splines import Track
+from topology import table_to_config
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+TRAVERSE_LIMIT = 500
+
+
+def good_table(n, rng):
+    """Port table of a good layout with n junctions (n even, at least 2)"""
+    # j1 and j2 are joined root to root, each with its own reversing loop
+    table = [3, 2, 1, 0, 5, 4]
+    while len(table) < 3 * n:
+        table = add_reversing_loop(table, int(rng.integers(len(table))))
+    return np.array(table, dtype=np.int32)
+
+
+def _timed(function, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmarks(config, traverse=True):
+    """(name, setup) pairs, setup() returns the function to time"""
+
+    def build():
+        return lambda: Track(config, seed=0)
+
+    def buildHeadless():
+        return lambda: Track(config, headless=True, seed=0)
+
+    def walk():
+        return Track(config, headless=True, seed=0).traverse
+
+    def findLoops():
+        return Track(config, headless=True, seed=0).findLoops
+
+    def checkLayout():
+        return Track(config, headless=True, seed=0).checkLayout
+
+    def runCurves():
+        # the one curve at a time path, a bezier_cubic call per run
+        T = Track(config, seed=0)
+
+        def run():
+            for r in T.runs:
+                r.calculateCurve()
+        return run
+
+    def calculateCurves():
+        return Track(config, seed=0).calculateCurves
+
+    def redraw():
+        T = Track(config, seed=0)
+        T.draw(analyse=False)  # drawing only, not the background analysis
+
+        def run():
+            T.redraw()
+            T.fig.canvas.draw()  # redraw only asks for a draw, make it happen
+        return run
+
+    paths = [('build', build),
+             ('build_headless', buildHeadless),
+             ('traverse', walk),
+             ('findLoops', findLoops),
+             ('checkLayout', checkLayout),
+             ('run_curves', runCurves),
+             ('calculate_curves', calculateCurves),
+             ('redraw', redraw)]
+    return [(name, setup) for name, setup in paths if traverse or name != 'traverse']
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeats=3, seed=0, only=None,
+                   traverseLimit=TRAVERSE_LIMIT, log=True):
+    """Time every benchmark on a random and a good layout of each size
+
+    Returns a list of dicts with the benchmark and layout, the best and
+    mean time over the repeats in seconds and the peak memory allocated by
+    one call in bytes (measured separately, tracemalloc slows things down).
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    results = []
+    for n in sizes:
+        rng = np.random.default_rng(seed)
+        layouts = {'random': random_tables(n, 1, rng)[0], 'good': good_table(n, rng)}
+        for kind, table in layouts.items():
+            config = table_to_config(table)
+            timeTraverse = kind == 'good' and n <= traverseLimit
+            for name, setup in benchmarks(config, timeTraverse):
+                if only and name not in only:
+                    continue
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')  # Agg can't show figures
+                    function = setup()
+                    times = _timed(function, repeats)
+                    peak = _peak_memory(function)
+                plt.close('all')
+                result = {'benchmark': name, 'layout': kind, 'junctions': n,
+                          'best': min(times), 'mean': sum(times) / len(times),
+                          'repeats': repeats, 'peak_bytes': peak}
+                results.append(result)
+                if log:
+                    print(f'{name:>16} {kind:>6} {n:>6}: {result["best"]:.6f} s, '
+                          f'{peak / 1024:.0f} KiB', flush=True)
+    return results
+
+
+def compare(results, previous):
+    """Ratio of new to old best time for every benchmark in both runs"""
+    old = {(r['benchmark'], r['layout'], r['junctions']): r['best'] for r in previous}
+    ratios = {}
+    for r in results:
+        key = (r['benchmark'], r['layout'], r['junctions'])
+        if key in old and old[key] > 0:
+            ratios[key] = r['best'] / old[key]
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='numbers of junctions (even)')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', help='names of the benchmarks to run')
+    parser.add_argument('--traverse-limit', type=int, default=TRAVERSE_LIMIT,
+                        help='largest layout to time traverse on')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.repeats, args.seed, args.only, args.traverse_limit)
+    import matplotlib
+    report = {'python': sys.version.split()[0],
+              'numpy': np.__version__,
+              'matplotlib': matplotlib.__version__,
+              'platform': platform.platform(),
+              'seed': args.seed,
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+        for (name, kind, n), ratio in compare(results, previous).items():
+            print(f'{name:>16} {kind:>6} {n:>6}: {ratio:.2f}x the previous time')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Which runs cross each other, and which pass too close to be built.
+
+Each run's curve is a chain of short straight segments. Every run is
+entered in a uniform grid under each cell its segments (padded by half the
+clearance) touch, so two runs can only be closer than the clearance if
+they share a cell. Only those pairs get an exact segment by segment test,
+and only the segments near the other run take part in it. When a junction
+moves, only its runs are re-entered in the grid and re-tested. The first
+build enters and tests every run at once, with whole arrays of segments
+rather than a run at a time, see close_segments.
+
+@author: Dan
+"""
+
+from collections import defaultdict
+
+import numpy as np
+
+
+def _cross(u, v):
+    return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+
+
+def _point_segment_distance(p, a, b):
+    ab = b - a
+    t = ((p - a) * ab).sum(axis=-1) / np.maximum((ab**2).sum(axis=-1), 1e-24)
+    t = np.clip(t, 0, 1)[..., None]
+    return np.sqrt(((a + t * ab - p)**2).sum(axis=-1))
+
+
+def segment_distances(a0, a1, b0, b1):
+    """Shortest distance between segments a0-a1 and b0-b1, 0 where they
+    intersect. All arguments broadcast against each other, shape (..., 2)"""
+    d1 = _cross(b1 - b0, a0 - b0)
+    d2 = _cross(b1 - b0, a1 - b0)
+    d3 = _cross(a1 - a0, b0 - a0)
+    d4 = _cross(a1 - a0, b1 - a0)
+    intersect = (d1 * d2 <= 0) & (d3 * d4 <= 0)
+    dist = np.minimum.reduce([_point_segment_distance(a0, b0, b1),
+                              _point_segment_distance(a1, b0, b1),
+                              _point_segment_distance(b0, a0, a1),
+                              _point_segment_distance(b1, a0, a1)])
+    return np.where(intersect, 0.0, dist)
+
+
+class ClearanceIndex():
+    # grid of the runs of a track, and the distance between every pair of
+    # runs that come closer than the clearance
+
+    def __init__(self, track, clearance=0.3, cellSize=None, build=True):
+        # with build=False the index stays empty until rebuild() is called,
+        # which uses the runs' curves as they are
+        self.track = track
+        self.clearance = clearance
+        self.cellSize = cellSize or clearance
+        self.runs = list(track.runs)
+        self.runIds = {id(r): i for i, r in enumerate(self.runs)}
+        self.runJunctions = [{r.start_junction.name, r.end_junction.name} for r in self.runs]
+        self.cells = defaultdict(set)  # (x, y) -> ids of runs with a segment there
+        self.runCells = [set() for r in self.runs]
+        self.pairs = {}  # (i, j), i < j -> shortest distance, if under the clearance
+        if build:
+            track.calculateCurves()
+            self.rebuild()
+
+    def rebuild(self):
+        """Index every run again from scratch"""
+        self.cells = defaultdict(set)
+        self.runCells = [set() for r in self.runs]
+        self.pairs = {}
+        curves = [r.curve for r in self.runs]
+        if curves:
+            # every run into its cells, and every pair measured, in one go
+            owner = np.repeat(np.arange(len(curves)), [len(c) - 1 for c in curves])
+            a = np.concatenate([c[:-1] for c in curves])
+            b = np.concatenate([c[1:] for c in curves])
+            for i, x, y in zip(*self._cellsOf(a, b, owner)):
+                self.cells[(x, y)].add(i)
+                self.runCells[i].add((x, y))
+            self.pairs = run_clearances(curves, None, self.clearance, self.cellSize)
+
+    def update(self, junction):
+        """Re-index the runs touching a junction after it has moved, its
+        runs' curves need to be up to date (Track.update_junction does this)"""
+        self.updateRuns(self.track.junctionRuns[junction.name])
+
+    def updateRuns(self, runs):
+        ids = [self.runIds[id(r)] for r in runs]
+        for i in ids:
+            self._enter(i)
+        for i in ids:
+            for pair in [p for p in self.pairs if i in p]:
+                del self.pairs[pair]
+        for i in ids:
+            self._measure(i)
+
+    def touching(self, i, j):
+        """True if runs i and j meet at a common junction"""
+        return bool(self.runJunctions[i] & self.runJunctions[j])
+
+    def crossings(self):
+        """Pairs of runs that cross each other"""
+        return [(self.runs[i], self.runs[j]) for (i, j), d in self.pairs.items() if d == 0]
+
+    def clearances(self):
+        """{(run, run): shortest distance} for every pair of runs closer than
+        the clearance. Runs that meet at a common junction are left out,
+        they have to come close there."""
+        return {(self.runs[i], self.runs[j]): d for (i, j), d in self.pairs.items()
+                if not self.touching(i, j)}
+
+    def minimumClearance(self):
+        """Shortest distance between any two runs not sharing a junction,
+        inf if none are closer than the clearance"""
+        return min(self.clearances().values(), default=np.inf)
+
+    def _segments(self, i):
+        curve = self.runs[i].curve
+        return curve[:-1], curve[1:]
+
+    def _enter(self, i):
+        # take the run out of the cells it was in, and put it in its new ones
+        for cell in self.runCells[i]:
+            members = self.cells[cell]
+            members.discard(i)
+            if not members:
+                del self.cells[cell]
+        a, b = self._segments(i)
+        _, x, y = self._cellsOf(a, b, np.zeros(len(a), dtype=np.intp))
+        cells = set(zip(x, y))
+        for cell in cells:
+            self.cells[cell].add(i)
+        self.runCells[i] = cells
+
+    def _cellsOf(self, a, b, owner):
+        # (owner, x, y) lists of the cells under the segments a-b, padded by
+        # half the clearance, each cell once per owner
+        pad = self.clearance / 2
+        lo = np.floor((np.minimum(a, b) - pad) / self.cellSize).astype(np.int64)
+        hi = np.floor((np.maximum(a, b) + pad) / self.cellSize).astype(np.int64)
+        segment, x, y = box_cells(lo, hi)
+        cells = np.unique(np.stack([owner[segment], x, y], axis=1), axis=0)
+        return cells.T.tolist()
+
+    def _measure(self, i, later=False):
+        # exact distances from run i to every run it shares a cell with,
+        # with later=True only to runs with higher ids (for the first build)
+        neighbours = set()
+        for cell in self.runCells[i]:
+            neighbours |= self.cells[cell]
+        neighbours.discard(i)
+        a0, a1 = self._segments(i)
+        for j in neighbours:
+            if later and j < i:
+                continue
+            pair = (min(i, j), max(i, j))
+            if pair in self.pairs:
+                continue
+            b0, b1 = self._segments(j)
+            d = self._distance(a0, a1, b0, b1)
+            if d < self.clearance:
+                self.pairs[pair] = d
+
+    def _distance(self, a0, a1, b0, b1):
+        # only segments within the clearance of the other run's box can matter
+        pad = self.clearance
+        aNear = self._inBox(a0, a1, np.minimum(b0, b1).min(axis=0) - pad, np.maximum(b0, b1).max(axis=0) + pad)
+        bNear = self._inBox(b0, b1, np.minimum(a0, a1).min(axis=0) - pad, np.maximum(a0, a1).max(axis=0) + pad)
+        if not aNear.any() or not bNear.any():
+            return np.inf
+        d = segment_distances(a0[aNear][:, None], a1[aNear][:, None], b0[bNear][None], b1[bNear][None])
+        return float(d.min())
+
+    @staticmethod
+    def _inBox(s0, s1, lo, hi):
+        return np.all((np.maximum(s0, s1) >= lo) & (np.minimum(s0, s1) <= hi), axis=1)
+
+
+def box_cells(lo, hi):
+    """(box, x, y) index arrays of every grid cell in each box, the boxes
+    given by their lowest and highest cells, (boxes, 2) int arrays"""
+    nx = hi[:, 0] - lo[:, 0] + 1
+    ny = hi[:, 1] - lo[:, 1] + 1
+    counts = nx * ny
+    box = np.repeat(np.arange(len(lo)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return box, lo[box, 0] + k // ny[box], lo[box, 1] + k % ny[box]
+
+
+def close_segments(a, b, owner, clearance, cellSize=None, chunksize=250000):
+    """Yield (i, j, distance) arrays for every pair of segments a[i]-b[i]
+    and a[j]-b[j] with different owners closer than the clearance, a
+    chunk at a time
+
+    Each segment is entered under every cell its box, padded by half the
+    clearance, touches, like ClearanceIndex does with whole runs. Two
+    segments are only compared in the cell at the low corner of where
+    their padded boxes overlap, so each pair is measured once, and at most
+    about chunksize pairs are compared at a time.
+    """
+    cellSize = cellSize or clearance
+    pad = clearance / 2
+    boxLo = np.minimum(a, b) - pad
+    boxHi = np.maximum(a, b) + pad
+    lo = np.floor(boxLo / cellSize).astype(np.int64)
+    hi = np.floor(boxHi / cellSize).astype(np.int64)
+    segment, x, y = box_cells(lo, hi)
+    if not len(segment):
+        return
+    lo -= [x.min(), y.min()]
+    x -= x.min()
+    y -= y.min()
+    height = y.max() + 1
+    keys = x * height + y
+    # grouped by cell, and within each cell by owner
+    order = np.lexsort((owner[segment], keys))
+    keys = keys[order]
+    segment = segment[order]
+    entryOwner = owner[segment]
+    entryLo = lo[segment]
+    changes = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    cellEnd = np.repeat(np.r_[changes, len(keys)], np.diff(np.r_[0, changes, len(keys)]))
+    changes = np.flatnonzero((keys[1:] != keys[:-1]) | (entryOwner[1:] != entryOwner[:-1])) + 1
+    ownerEnd = np.repeat(np.r_[changes, len(keys)], np.diff(np.r_[0, changes, len(keys)]))
+    # each entry is paired with the entries of other owners after it in its
+    # cell, split into chunks of roughly chunksize pairs
+    later = cellEnd - ownerEnd
+    work = np.cumsum(later)
+    bounds = np.searchsorted(work, np.arange(chunksize, work[-1], chunksize), side='right')
+    bounds = np.unique(np.r_[0, bounds, len(keys)])
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        counts = later[first:last]
+        p = np.repeat(np.arange(first, last), counts)
+        q = np.repeat(ownerEnd[first:last] - np.cumsum(counts) + counts, counts) + np.arange(len(p))
+        # only in the cell at the low corner of where the boxes overlap
+        corner = (np.maximum(entryLo[p, 0], entryLo[q, 0]) * height
+                  + np.maximum(entryLo[p, 1], entryLo[q, 1]))
+        here = corner == keys[p]
+        i, j = segment[p[here]], segment[q[here]]
+        # boxes padded by half the clearance have to overlap
+        overlap = np.all((boxLo[i] <= boxHi[j]) & (boxLo[j] <= boxHi[i]), axis=1)
+        i, j = i[overlap], j[overlap]
+        d = segment_distances(a[i], b[i], a[j], b[j])
+        close = d < clearance
+        yield i[close], j[close], d[close]
+
+
+def run_clearances(curves, runJunctions=None, clearance=0.3, cellSize=None):
+    """{(i, j): shortest distance}, i < j, for every pair of runs closer than
+    the clearance, worked out in one go from a list of their curves.
+
+    The same answer as ClearanceIndex.clearances, by run id, without
+    keeping an index or needing the track, so it can be given a snapshot
+    of the curves to work on in another thread. runJunctions is a (runs, 2)
+    array of the junction at each end of each run, runs sharing a junction
+    are left out. With runJunctions None every pair is kept, like
+    ClearanceIndex.pairs.
+    """
+    counts = np.array([len(c) - 1 for c in curves], dtype=np.intp)
+    if counts.sum() < 2:
+        return {}
+    a = np.concatenate([c[:-1] for c in curves])
+    b = np.concatenate([c[1:] for c in curves])
+    owner = np.repeat(np.arange(len(curves)), counts)
+    if runJunctions is not None:
+        runJunctions = np.asarray(runJunctions)
+    pairs = {}
+    for i, j, d in close_segments(a, b, owner, clearance, cellSize):
+        ri, rj = owner[i], owner[j]
+        if runJunctions is not None:
+            ji, jj = runJunctions[ri], runJunctions[rj]
+            apart = ((ji[:, 0] != jj[:, 0]) & (ji[:, 0] != jj[:, 1])
+                     & (ji[:, 1] != jj[:, 0]) & (ji[:, 1] != jj[:, 1]))
+            ri, rj, d = ri[apart], rj[apart], d[apart]
+        lo = np.minimum(ri, rj)
+        hi = np.maximum(ri, rj)
+        # shortest distance per pair of runs in this chunk, then overall
+        order = np.lexsort((d, hi, lo))
+        lo, hi, d = lo[order], hi[order], d[order]
+        first = np.ones(len(d), dtype=bool)
+        first[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+        for pair in zip(lo[first].tolist(), hi[first].tolist(), d[first].tolist()):
+            if pair[2] < pairs.get(pair[:2], np.inf):
+                pairs[pair[:2]] = pair[2]
+    return pairs
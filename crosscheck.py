@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Check the fast good/bad machinery against brute force on small layouts.
+
+For every way of joining up the ports of n junctions (10395 tables for
+n = 4, too many to try beyond that), a layout is judged by following the same
+moves as Track.traverse, into a junction at the root and out by either
+branch, or in by a branch and out at the root, then along the run, from
+every state of the train to see whether it can get to every other. That
+verdict has to agree with topology.check_table on every table, with the
+verdict cache (verify.canonical_key) on every table of the same layout,
+and the number of good and bad layouts has to agree with
+enumeration.enumerate_tables. Run it after changing any of them:
+
+    python crosscheck.py --junctions 2 4
+
+@author: Dan
+"""
+
+import argparse
+import sys
+
+from enumeration import enumerate_tables
+from topology import ROOT, LEFT, RIGHT, check_table
+from verify import canonical_key
+
+
+def all_tables(n):
+    """Yield every port table with n junctions, every port joined to one
+    other, as lists"""
+    table = [-1] * (3 * n)
+
+    def extend(p):
+        while p < len(table) and table[p] != -1:
+            p += 1
+        if p == len(table):
+            yield list(table)
+            return
+        for q in range(p + 1, len(table)):
+            if table[q] == -1:
+                table[p], table[q] = q, p
+                yield from extend(p + 1)
+                table[p] = table[q] = -1
+
+    yield from extend(0)
+
+
+def connected(table):
+    n = len(table) // 3
+    seen = {0}
+    stack = [0]
+    while stack:
+        j = stack.pop()
+        for port in range(3):
+            k = table[3 * j + port] // 3
+            if k not in seen:
+                seen.add(k)
+                stack.append(k)
+    return len(seen) == n
+
+
+def brute_force_good(table):
+    """True if a train can get from any position on the layout, facing
+    either way, to any other, found by trying every route"""
+    # a state is (port, entering) where entering says the train is about to
+    # go into the port's junction rather than out along its run
+    def moves(port, entering):
+        if not entering:
+            return [(table[port], True)]
+        j, slot = divmod(port, 3)
+        if slot == ROOT:
+            return [(3 * j + LEFT, False), (3 * j + RIGHT, False)]
+        return [(3 * j + ROOT, False)]
+
+    states = [(port, entering) for port in range(len(table)) for entering in (False, True)]
+    for start in states:
+        seen = {start}
+        stack = [start]
+        while stack:
+            for state in moves(*stack.pop()):
+                if state not in seen:
+                    seen.add(state)
+                    stack.append(state)
+        if len(seen) < len(states):
+            return False
+    return True
+
+
+def crosscheck(n):
+    """(good, bad) layout counts from enumerate_tables and from brute force
+    over every table, and the tables where the verdicts disagree"""
+    problems = []
+    verdicts = {}  # canonical key -> brute force verdict
+    for table in all_tables(n):
+        good = brute_force_good(table)
+        if check_table(table)[0] != good:
+            problems.append(('check_table', table))
+        if connected(table):
+            key = canonical_key(table)
+            if verdicts.setdefault(key, good) != good:
+                problems.append(('canonical_key', table))
+    bruteGood = sum(verdicts.values())
+    bruteCounts = (bruteGood, len(verdicts) - bruteGood)
+
+    good = bad = 0
+    for table in enumerate_tables(n):
+        key = canonical_key(table)
+        if key not in verdicts:
+            problems.append(('enumerate_tables', table.tolist()))
+        elif verdicts[key] != check_table(table)[0]:
+            problems.append(('enumerate_tables', table.tolist()))
+        if check_table(table)[0]:
+            good += 1
+        else:
+            bad += 1
+    return (good, bad), bruteCounts, problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--junctions', type=int, nargs='+', default=[2, 4],
+                        help='numbers of junctions (even)')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for n in args.junctions:
+        counts, bruteCounts, problems = crosscheck(n)
+        print(f'{n} junctions: enumerate_tables {counts[0]} good, {counts[1]} bad; '
+              f'brute force {bruteCounts[0]} good, {bruteCounts[1]} bad')
+        for name, table in problems[:10]:
+            print(f'    {name} disagrees with brute force on {table}')
+        if problems or counts != bruteCounts:
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
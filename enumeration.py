@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Enumerate every layout with N junctions, once per isomorphism class.
+
+Two layouts are the same if one can be turned into the other by renaming
+junctions and swapping the left and right ports of some junctions (which
+is what Junction.swap does to the drawing). Only connected layouts are
+generated: a layout in more than one piece is never good, as a train can't
+get from one piece to the other.
+
+Layouts are built in a canonical "breadth first" form: junction 0 is the
+start, the lowest numbered open port is always the next one to be
+connected, and a junction gets the next free id the first time a run
+reaches it. A junction reached for the first time through one of its
+branches is always reached through its left port, and while both branches
+of a junction are still open only the left one is offered. That removes
+nearly all of the N! relabelings and 2^N swaps while the layout is being
+built. What's left is only the choice of start junction, and of which
+branch is left at junctions first reached through their root, which is
+settled by keeping the layout only if no other choice gives a
+lexicographically smaller port table.
+
+Finding that smallest table for a layout that wasn't built this way
+(canonical_table) means trying both branches at every junction first
+reached through its root, which takes exponential time on big layouts.
+Those can instead be relabelled by colour refinement, which tells ports
+apart by what they're joined to, then by what that is joined to and so
+on, and settles every choice by colour in polynomial time.
+
+@author: Dan
+"""
+
+import numpy as np
+
+from topology import ROOT, LEFT, RIGHT, is_good, table_to_config
+
+# layouts with up to this many junctions get the exact canonical form by
+# default, bigger ones the refined form, see canonical_table
+EXACT_JUNCTIONS = 16
+# most starting junctions tried when their colours tie, see _refined_relabelling
+TIED_STARTS = 8
+
+
+def enumerate_tables(n):
+    """Yield the port table of every connected layout with n junctions
+
+    One table per isomorphism class, as an np.array of int32. The number
+    of ports (3n) has to be even, so there are no layouts for odd n.
+    """
+    if n <= 0 or n % 2:
+        return
+    table = [-1] * (3 * n)
+    yield from _extend(table, n, 1, 0)
+
+
+def enumerate_layouts(n):
+    """Like enumerate_tables, but yield run configs ready for Track"""
+    for table in enumerate_tables(n):
+        yield table_to_config(table)
+
+
+def _extend(table, n, nLabelled, p):
+    # find the lowest numbered open port on a junction we have reached
+    nPorts = 3 * nLabelled
+    while p < nPorts and table[p] != -1:
+        p += 1
+    if p == nPorts:
+        # nothing left to connect, unless this piece is smaller than the
+        # whole layout, in which case it's disconnected and not wanted
+        if nLabelled == n:
+            yield np.array(table, dtype=np.int32)
+        return
+
+    # connect it to an open port on a junction we have already reached
+    for q in range(p + 1, nPorts):
+        if table[q] != -1:
+            continue
+        if q % 3 == RIGHT and q - 1 != p and table[q - 1] == -1:
+            continue  # both branches open, only the left one is offered
+        table[p] = q
+        table[q] = p
+        if _is_canonical(table, n):
+            yield from _extend(table, n, nLabelled, p + 1)
+        table[q] = -1
+    # or to the root or left port of a new junction
+    if nLabelled < n:
+        for q in (nPorts + ROOT, nPorts + LEFT):
+            table[p] = q
+            table[q] = p
+            if _is_canonical(table, n):
+                yield from _extend(table, n, nLabelled + 1, p + 1)
+            table[q] = -1
+    table[p] = -1
+
+
+def _is_canonical(code, n):
+    """True if no other start junction / branch choice gives a smaller table
+
+    code can be a partly built table (-1 for ports not connected yet), then
+    the comparison stops at the first port that isn't known, so a False
+    means no way of finishing the table can make it canonical.
+    """
+    for start in range(n):
+        newOf = [-1] * n  # original junction id -> canonical id
+        origOf = [-1] * n  # canonical id -> original junction id
+        swapped = [-1] * n  # per canonical id, -1 = not decided yet
+        newOf[start] = 0
+        origOf[0] = start
+        if _beats(code, n, 0, newOf, origOf, swapped, [-1] * (3 * n), 1):
+            return False
+    return True
+
+
+def _beats(code, n, i, newOf, origOf, swapped, newTable, nLabelled):
+    """Relabel code in canonical form from port i on, True if the result is
+    lexicographically smaller than code itself"""
+    while i < 3 * n:
+        if newTable[i] == -1:
+            k, slot = divmod(i, 3)
+            if slot == ROOT:
+                orig = 3 * origOf[k]
+            elif swapped[k] == -1:
+                # first branch of a junction reached through its root,
+                # either of its branches could be called left
+                for choice in (0, 1):
+                    branchSwapped = swapped.copy()
+                    branchSwapped[k] = choice
+                    if _beats(code, n, i, newOf.copy(), origOf.copy(), branchSwapped,
+                              newTable.copy(), nLabelled):
+                        return True
+                return False
+            else:
+                orig = 3 * origOf[k] + (3 - slot if swapped[k] else slot)
+
+            if code[orig] == -1:
+                return False  # not built that far yet, can't tell
+            origJunction, origSlot = divmod(code[orig], 3)
+            m = newOf[origJunction]
+            if m == -1:
+                # first time we reach this junction
+                m = nLabelled
+                nLabelled += 1
+                newOf[origJunction] = m
+                origOf[m] = origJunction
+            if origSlot == ROOT:
+                newSlot = ROOT
+            elif swapped[m] == -1:
+                swapped[m] = int(origSlot == RIGHT)
+                newSlot = LEFT
+            else:
+                newSlot = 3 - origSlot if swapped[m] else origSlot
+            q = 3 * m + newSlot
+            newTable[i] = q
+            newTable[q] = i
+
+        if code[i] == -1:
+            return False
+        if newTable[i] != code[i]:
+            return newTable[i] < code[i]
+        i += 1
+    return False
+
+
+def canonical_table(table, exact=None):
+    """The canonical form of any complete port table
+
+    Junctions are renamed and swapped so that any two tables describing the
+    same layout come out identical, the same form enumerate_tables yields.
+    A layout in several pieces has each piece put in canonical form, and
+    the pieces are sorted (smallest first) and numbered one after another.
+
+    That form can take exponential time to find, so if exact is False (by
+    default if there are more than EXACT_JUNCTIONS junctions) the pieces are
+    relabelled by colour refinement instead, see _refined_relabelling. Two
+    tables of the same layout nearly always come out identical that way
+    too, and tables of different layouts never do.
+    """
+    table = np.asarray(table).tolist()
+    if -1 in table:
+        raise ValueError('Every port needs to be connected to have a canonical form')
+    n = len(table) // 3
+    if exact is None:
+        exact = n <= EXACT_JUNCTIONS
+    relabelling = _smallest_relabelling if exact else _refined_relabelling
+
+    # split into connected pieces, each renumbered from 0 in junction order
+    pieceOf = [-1] * n
+    pieces = []
+    for start in range(n):
+        if pieceOf[start] != -1:
+            continue
+        pieceOf[start] = len(pieces)
+        members = [start]
+        stack = [start]
+        while stack:
+            j = stack.pop()
+            for port in range(3):
+                k = table[3 * j + port] // 3
+                if pieceOf[k] == -1:
+                    pieceOf[k] = pieceOf[start]
+                    members.append(k)
+                    stack.append(k)
+        pieces.append(sorted(members))
+
+    codes = []
+    for members in pieces:
+        newId = {j: i for i, j in enumerate(members)}
+        sub = [3 * newId[q // 3] + q % 3 for j in members for q in table[3 * j:3 * j + 3]]
+        codes.append(relabelling(sub, len(members)))
+    codes.sort(key=lambda code: (len(code), code))
+
+    canonical = []
+    for code in codes:
+        offset = len(canonical)
+        canonical.extend(q + offset for q in code)
+    return np.array(canonical, dtype=np.int32)
+
+
+def _smallest_relabelling(code, n):
+    best = [None]
+    for start in range(n):
+        newOf = [-1] * n
+        origOf = [-1] * n
+        swapped = [-1] * n
+        newOf[start] = 0
+        origOf[0] = start
+        _smallest(code, n, 0, newOf, origOf, swapped, [-1] * (3 * n), 1, best, None)
+    return best[0]
+
+
+def _smallest(code, n, i, newOf, origOf, swapped, newTable, nLabelled, best, smaller):
+    # same relabelling as _beats, but keeping the smallest complete table
+    # in best[0]. smaller is True once the table is known to be below
+    # best[0], False while it's equal so far, None if that needs checking
+    if smaller is None and best[0] is not None:
+        prefix, bestPrefix = newTable[:i], best[0][:i]
+        if prefix > bestPrefix:
+            return
+        smaller = prefix < bestPrefix
+    while i < 3 * n:
+        if newTable[i] == -1:
+            k, slot = divmod(i, 3)
+            if slot == ROOT:
+                orig = 3 * origOf[k]
+            elif swapped[k] == -1:
+                for choice in (0, 1):
+                    branchSwapped = swapped.copy()
+                    branchSwapped[k] = choice
+                    # best[0] may have changed in the first branch
+                    _smallest(code, n, i, newOf.copy(), origOf.copy(), branchSwapped,
+                              newTable.copy(), nLabelled, best, None)
+                return
+            else:
+                orig = 3 * origOf[k] + (3 - slot if swapped[k] else slot)
+
+            origJunction, origSlot = divmod(code[orig], 3)
+            m = newOf[origJunction]
+            if m == -1:
+                m = nLabelled
+                nLabelled += 1
+                newOf[origJunction] = m
+                origOf[m] = origJunction
+            if origSlot == ROOT:
+                newSlot = ROOT
+            elif swapped[m] == -1:
+                swapped[m] = int(origSlot == RIGHT)
+                newSlot = LEFT
+            else:
+                newSlot = 3 - origSlot if swapped[m] else origSlot
+            q = 3 * m + newSlot
+            newTable[i] = q
+            newTable[q] = i
+
+        if not smaller and best[0] is not None:
+            if newTable[i] > best[0][i]:
+                return
+            smaller = newTable[i] < best[0][i]
+        i += 1
+    best[0] = newTable
+
+
+def _port_colours(table, colour=None):
+    """Colour refinement of the ports of a complete port table, an int
+    array with the same colour for ports that can't be told apart by
+    following runs and junctions from them
+
+    Roots and branches start out different colours (or start from colour,
+    numbered 0, 1, ...), and each round a port's new colour is its colour
+    along with the colours of the port at the other end of its run and of
+    the other two ports of its junction (the branches of a root as an
+    unordered pair). Colours are numbered in sorted order of all that, so
+    they don't depend on junction names or swaps.
+    """
+    table = np.asarray(table)
+    ports = np.arange(len(table))
+    slot = ports % 3
+    junction = ports - slot
+    if colour is None:
+        colour = (slot != ROOT).astype(np.int64)
+    while True:
+        root, left, right = colour[junction], colour[junction + LEFT], colour[junction + RIGHT]
+        first = np.where(slot == ROOT, np.minimum(left, right), root)
+        second = np.where(slot == ROOT, np.maximum(left, right), np.where(slot == LEFT, right, left))
+        # numbered in sorted order of (colour, colour at the other end,
+        # first, second), two colours at a time so the numbers can't overflow
+        base = colour.max() + 1
+        near = np.unique(colour * base + colour[table], return_inverse=True)[1].reshape(-1)
+        far = np.unique(first * base + second, return_inverse=True)[1].reshape(-1)
+        refined = np.unique(near * len(table) + far, return_inverse=True)[1].reshape(-1)
+        # each round only ever splits colours, so it's done when none split
+        if refined.max() == colour.max():
+            return refined
+        colour = refined
+
+
+def _single_out(table, colour, port):
+    # refined colours after giving port a colour of its own
+    colour = np.array(colour, dtype=np.int64)
+    colour[port] = colour.max() + 1
+    return _port_colours(table, colour).tolist()
+
+
+def _refined_relabelling(code, n):
+    # the smallest of the relabellings from each junction whose root has
+    # the lowest colour, see _refined_from, or from the first TIED_STARTS
+    # of them. Each start means refining the colours again, and any of them
+    # does if they're all symmetric, as they nearly always are.
+    colour = _port_colours(code).tolist()
+    roots = colour[::3]
+    lowest = min(roots)
+    starts = [j for j in range(n) if roots[j] == lowest][:TIED_STARTS]
+    if len(starts) == 1:
+        return _refined_from(code, n, starts[0], colour)
+    return min(_refined_from(code, n, start, _single_out(code, colour, 3 * start))
+               for start in starts)
+
+
+def _refined_from(code, n, start, colour):
+    # the same breadth first relabelling as _smallest from start, taking
+    # the branch with the lower colour as left at junctions first reached
+    # through their root. A tie, which is nearly always a symmetry of what's
+    # been labelled so far, goes to the original left, and that port is
+    # given a colour of its own before going on, so later choices don't
+    # depend on the original swaps as well.
+    newOf = [-1] * n
+    origOf = [-1] * n
+    swapped = [-1] * n
+    newOf[start] = 0
+    origOf[0] = start
+    newTable = [-1] * (3 * n)
+    nLabelled = 1
+    for i in range(3 * n):
+        if newTable[i] != -1:
+            continue
+        k, slot = divmod(i, 3)
+        if slot == ROOT:
+            orig = 3 * origOf[k]
+        else:
+            if swapped[k] == -1:
+                left, right = colour[3 * origOf[k] + LEFT], colour[3 * origOf[k] + RIGHT]
+                swapped[k] = int(right < left)
+                if left == right:
+                    colour = _single_out(code, colour, 3 * origOf[k] + LEFT)
+            orig = 3 * origOf[k] + (3 - slot if swapped[k] else slot)
+
+        origJunction, origSlot = divmod(code[orig], 3)
+        m = newOf[origJunction]
+        if m == -1:
+            m = nLabelled
+            nLabelled += 1
+            newOf[origJunction] = m
+            origOf[m] = origJunction
+        if origSlot == ROOT:
+            newSlot = ROOT
+        elif swapped[m] == -1:
+            swapped[m] = int(origSlot == RIGHT)
+            newSlot = LEFT
+        else:
+            newSlot = 3 - origSlot if swapped[m] else origSlot
+        q = 3 * m + newSlot
+        newTable[i] = q
+        newTable[q] = i
+    return newTable
+
+
+if __name__ == "__main__":
+
+    # tabulate good and bad layouts for small numbers of junctions
+    for n in range(2, 9, 2):
+        nGood = nBad = 0
+        for table in enumerate_tables(n):
+            if is_good(table):
+                nGood += 1
+            else:
+                nBad += 1
+        print(f'{n} junctions: {nGood + nBad} layouts, {nGood} good, {nBad} bad')
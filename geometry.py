@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Batched Bezier geometry for a whole Track.
+
+Every run and every junction branch is a cubic Bezier curve. Rather than
+evaluating them one at a time, all the control points are stacked into one
+(M, 4, 2) array and multiplied by a cached (n, 4) Bernstein basis, giving
+every curve in the layout at once.
+
+@author: Dan
+"""
+
+import numpy as np
+
+from topology import ROOT, LEFT, RIGHT, PORT_NAMES, PORT_INDEX
+
+_bases = {}  # n -> (n, 4) Bernstein basis, shared by every curve
+_derivatives = {}  # n -> (n, 4) bases of the first and second derivatives
+_quadratures = {}  # order -> Gauss-Legendre nodes and weights on [0, 1]
+
+
+def bernstein_at(t):
+    """(len(t), 4) array of the cubic Bernstein polynomials at t"""
+    t = np.asarray(t, dtype=float)
+    return np.stack([(1 - t)**3,
+                     3 * (1 - t)**2 * t,
+                     3 * (1 - t) * t**2,
+                     t**3], axis=-1)
+
+
+def bernstein_derivatives_at(t):
+    """(len(t), 4) bases for the first and second derivatives of a cubic
+    Bezier at t"""
+    t = np.asarray(t, dtype=float)
+    d1 = np.stack([-3 * (1 - t)**2,
+                   3 * (1 - t)**2 - 6 * (1 - t) * t,
+                   6 * (1 - t) * t - 3 * t**2,
+                   3 * t**2], axis=-1)
+    d2 = np.stack([6 * (1 - t),
+                   -12 * (1 - t) + 6 * t,
+                   6 * (1 - t) - 12 * t,
+                   6 * t], axis=-1)
+    return d1, d2
+
+
+def bernstein_basis(n=100):
+    """(n, 4) array of the cubic Bernstein polynomials at n evenly spaced t"""
+    basis = _bases.get(n)
+    if basis is None:
+        basis = bernstein_at(np.linspace(0, 1, n))
+        basis.setflags(write=False)
+        _bases[n] = basis
+    return basis
+
+
+def bernstein_derivatives(n):
+    """(n, 4) bases for the first and second derivatives of a cubic Bezier
+    at n evenly spaced t"""
+    d = _derivatives.get(n)
+    if d is None:
+        d = bernstein_derivatives_at(np.linspace(0, 1, n))
+        for basis in d:
+            basis.setflags(write=False)
+        _derivatives[n] = d
+    return d
+
+
+def gauss_legendre(order=8):
+    """Gauss-Legendre nodes t on [0, 1] and their weights, which sum to 1"""
+    q = _quadratures.get(order)
+    if q is None:
+        x, w = np.polynomial.legendre.leggauss(order)
+        q = ((x + 1) / 2, w / 2)
+        _quadratures[order] = q
+    return q
+
+
+def bezier_cubic(P0, P1, P2, P3, n=100):
+    """Points on a single cubic Bezier curve, shape (n, 2)"""
+    return bernstein_basis(n) @ np.array([P0, P1, P2, P3])
+
+
+def bezier_cubics(control, n=100):
+    """Points on many cubic Bezier curves at once
+
+    Parameters
+    ----------
+    control : np.array, shape (M, 4, 2)
+        control points P0..P3 of M curves
+
+    Returns
+    -------
+    np.array, shape (M, n, 2)
+    """
+    return np.matmul(bernstein_basis(n), control)
+
+
+def sample_counts(control, tolerance, maxPoints=100):
+    """Number of points each curve needs so no chord strays more than
+    tolerance from the curve
+
+    Wang's formula bounds the number of segments of a cubic by
+    sqrt(3 / 4 * max |P_i - 2 P_i+1 + P_i+2| / tolerance). The count is
+    rounded up to 2^k + 1 points so only a few basis tables are ever
+    needed, and is at least 2 and at most maxPoints.
+    """
+    control = np.asarray(control, dtype=float)
+    second = control[:, :-2] - 2 * control[:, 1:-1] + control[:, 2:]
+    m = np.sqrt((second**2).sum(axis=2)).max(axis=1)
+    segments = np.ceil(np.sqrt(0.75 * m / tolerance))
+    segments = 2**np.ceil(np.log2(np.maximum(segments, 1)))
+    return np.minimum(segments + 1, maxPoints).astype(int)
+
+
+def bezier_cubics_adaptive(control, tolerance, maxPoints=100):
+    """Points on many cubic Bezier curves, each with as few points as it
+    needs to stay within tolerance of the curve (see sample_counts)
+
+    Returns a list of M arrays of shape (points, 2). Curves with the same
+    number of points are evaluated together.
+    """
+    control = np.asarray(control, dtype=float)
+    counts = sample_counts(control, tolerance, maxPoints)
+    curves = [None] * len(control)
+    for n in np.unique(counts).tolist():
+        which = np.nonzero(counts == n)[0]
+        for i, curve in zip(which.tolist(), bezier_cubics(control[which], n)):
+            curves[i] = curve
+    return curves
+
+
+def bezier_lengths(control, order=16):
+    """Arc length of each of many cubic Bezier curves, (M, 4, 2) -> (M,)
+
+    The speed |P'(t)| is known exactly from the control points, and is
+    integrated by Gauss-Legendre quadrature with order nodes, without
+    sampling points along the curve. With 16 nodes typical runs come out
+    within 0.001% of their true length, tight loops within 0.3%.
+    """
+    t, w = gauss_legendre(order)
+    d1 = bernstein_derivatives_at(t)[0]
+    D1 = np.matmul(d1, np.asarray(control, dtype=float))
+    return np.sqrt((D1**2).sum(axis=-1)) @ w
+
+
+def bezier_curvature(control, t):
+    """Signed curvature of each of many cubic Bezier curves at t, (M, len(t))
+
+    Positive where the curve bends to the left.
+    """
+    d1, d2 = bernstein_derivatives_at(np.atleast_1d(t))
+    control = np.asarray(control, dtype=float)
+    D1 = np.matmul(d1, control)
+    D2 = np.matmul(d2, control)
+    cross = D1[..., 0] * D2[..., 1] - D1[..., 1] * D2[..., 0]
+    speed = np.sqrt((D1**2).sum(axis=-1))
+    return cross / np.maximum(speed, 1e-12)**3
+
+
+def close_point_pairs(points, radius, subset=None):
+    """Index arrays (i, j), i < j, of all pairs of points closer than radius
+
+    Points are dropped into a uniform grid of cells radius wide, so only
+    points in the same or neighbouring cells are ever compared. With subset,
+    a bool array over the points, only pairs with at least one point in the
+    subset are found, and only the subset's neighbourhoods are searched.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) < 2:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    cells = np.floor(points / radius).astype(np.int64)
+    cells -= cells.min(axis=0)
+    # two spare columns so stepping one cell up or down never wraps
+    # into the neighbouring row of cells
+    width = cells[:, 1].max() + 3
+    keys = cells[:, 0] * width + cells[:, 1] + 1
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+
+    first = []
+    second = []
+    if subset is None:
+        everyPoint = np.arange(len(points))
+        # half of the 3x3 neighbourhood, so each pair of cells is visited once
+        neighbours = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+    else:
+        everyPoint = np.nonzero(subset)[0]
+        neighbours = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+    for dx, dy in neighbours:
+        target = keys[everyPoint] + dx * width + dy
+        lo = np.searchsorted(sortedKeys, target, side='left')
+        counts = np.searchsorted(sortedKeys, target, side='right') - lo
+        i = np.repeat(everyPoint, counts)
+        offsets = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(lo, counts) + offsets]
+        if subset is not None:
+            # pairs with both points in the subset are found from both ends
+            keep = ~subset[j] | (i < j)
+            i, j = i[keep], j[keep]
+        elif dx == 0 and dy == 0:
+            keep = i < j
+            i, j = i[keep], j[keep]
+        first.append(i)
+        second.append(j)
+    i = np.concatenate(first)
+    j = np.concatenate(second)
+    close = ((points[i] - points[j])**2).sum(axis=1) < radius**2
+    i, j = i[close], j[close]
+    swap = i > j
+    return np.where(swap, j, i), np.where(swap, i, j)
+
+
+class JunctionStore():
+    # position, direction, swap state and scale of many junctions, plus the
+    # endpoints and gradients of all their ports, held in flat arrays so the
+    # frames of every junction can be worked out in one vectorized pass.
+    # endpoints and gradients are (3 * n, 2), indexed by port number.
+
+    def __init__(self, n):
+        self.n = n
+        self.loc = np.zeros((n, 2))
+        self.direction = np.zeros(n)
+        self.swapped = np.ones(n, dtype=int)  # or -1
+        self.scale = np.full(n, 0.5)
+        self.rot = np.zeros((n, 2, 2))
+        self.endpoints = np.zeros((3 * n, 2))
+        self.gradients = np.zeros((3 * n, 2))
+        # (n, 3, 2) views of the same data, indexed by junction then port
+        self._endpoints = self.endpoints.reshape(n, 3, 2)
+        self._gradients = self.gradients.reshape(n, 3, 2)
+
+    @classmethod
+    def random(cls, n, rng=np.random):
+        """Junctions scattered at random positions and directions, rng can
+        be np.random (the global state) or a numpy Generator"""
+        store = cls(n)
+        store.loc[:] = rng.standard_normal((n, 2)) * 2
+        store.direction[:] = rng.random(n) * 360
+        store.update()
+        return store
+
+    def update(self, index=slice(None)):
+        """Recalculate the rotation matrices, endpoints and gradients
+
+        index can be a single junction id, a slice or an array of ids,
+        by default every junction is updated.
+        """
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1)
+        theta = np.deg2rad(self.direction[index])
+        c = np.cos(theta)
+        s = np.sin(theta)
+        self.rot[index] = np.stack([np.stack([c, -s], axis=-1),
+                                    np.stack([s, c], axis=-1)], axis=-2)
+
+        def rotated(a, b):
+            # the row vector [a, b] @ rotation_matrix(direction)
+            return np.stack([a * c + b * s, b * c - a * s], axis=-1)
+
+        sw = self.swapped[index]
+        loc = self.loc[index]
+        self._endpoints[index, ROOT] = loc
+        self._endpoints[index, LEFT] = loc + rotated(sw * -0.5, 1)
+        self._endpoints[index, RIGHT] = loc + rotated(sw * 0.5, 1)
+        # note the root gradient is pointing away from the root
+        self._gradients[index, ROOT] = rotated(0, -0.707)
+        self._gradients[index, LEFT] = rotated(sw * -0.5, 0.5)
+        self._gradients[index, RIGHT] = rotated(sw * 0.5, 0.5)
+
+
+class PortArrays():
+    # dict-like view of one junction's rows of a (3 * n, 2) port array,
+    # so junction.endpoints['left'] works without a dict per junction
+    __slots__ = ('array', 'index')
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    def __getitem__(self, port):
+        return self.array[3 * self.index + PORT_INDEX[port]]
+
+    def keys(self):
+        return PORT_NAMES
+
+    def values(self):
+        return [self[port] for port in PORT_NAMES]
+
+    def items(self):
+        return [(port, self[port]) for port in PORT_NAMES]
+
+
+class TrackGeometry():
+    # the curves of every run and junction branch in a track, computed in
+    # one go from the track's JunctionStore. With a tolerance every curve
+    # gets only as many points as it needs (see bezier_cubics_adaptive),
+    # otherwise they all get n. The tolerance is in layout units divided
+    # by viewScale, so with viewScale in pixels per unit it's in pixels.
+
+    def __init__(self, track, n=100, tolerance=None, viewScale=1.0):
+        self.track = track
+        self.n = n
+        self.tolerance = tolerance
+        self.viewScale = viewScale
+        self.junctions = [track.junctions[name] for name in track.junctionNames]
+        self.runs = list(track.runs)
+        # (number of runs, 2) port numbers at each end of each run
+        self.runPorts = np.array([[3 * track.junctionIds[r.start_junction.name] + PORT_INDEX[r.start_port],
+                                   3 * track.junctionIds[r.end_junction.name] + PORT_INDEX[r.end_port]]
+                                  for r in self.runs], dtype=np.intp).reshape(-1, 2)
+        # ids of the runs touching each junction
+        runIds = {id(r): i for i, r in enumerate(self.runs)}
+        self.junctionRunIds = [np.array([runIds[id(r)] for r in track.junctionRuns[name]], dtype=np.intp)
+                               for name in track.junctionNames]
+        self.gather()
+
+    def gather(self):
+        """Pick up the current junction arrays and run scales"""
+        store = self.track.store
+        self.endpoints = store.endpoints
+        self.gradients = store.gradients
+        self.junctionScales = store.scale
+        self.runScales = np.array([r.scale for r in self.runs], dtype=float)
+
+    def controlPoints(self, runs=None, junctions=None):
+        """(runs + 2 * junctions, 4, 2) control points, runs first, then
+        every junction's left branch, then every junction's right branch.
+        runs and junctions are arrays of ids, by default all of them."""
+        if runs is None:
+            runs = np.arange(len(self.runs))
+        if junctions is None:
+            junctions = np.arange(len(self.junctions))
+        ports = self.runPorts[runs]
+        runScales = self.runScales[runs][:, None]
+        start = self.endpoints[ports[:, 0]]
+        end = self.endpoints[ports[:, 1]]
+        runControl = np.stack([start,
+                               start + self.gradients[ports[:, 0]] * runScales,
+                               end + self.gradients[ports[:, 1]] * runScales,
+                               end], axis=1)
+
+        # note, bezier gradient rule for the root gradient is reversed
+        # here so both branches converge at the root
+        scale = self.junctionScales[junctions][:, None]
+        root = self.endpoints[3 * junctions + ROOT]
+        rootControl = root - self.gradients[3 * junctions + ROOT] * scale
+        branchControl = []
+        for port in (LEFT, RIGHT):
+            tip = self.endpoints[3 * junctions + port]
+            branchControl.append(np.stack([root,
+                                           rootControl,
+                                           tip - self.gradients[3 * junctions + port] * scale,
+                                           tip], axis=1))
+        return np.concatenate([runControl] + branchControl, axis=0)
+
+    def sample(self, control):
+        """Points on the curves with these control points, an (M, n, 2)
+        array, or a list of M arrays when sampling adaptively"""
+        if self.tolerance is None:
+            return bezier_cubics(control, self.n)
+        return bezier_cubics_adaptive(control, self.tolerance / self.viewScale, self.n)
+
+    def calculateCurves(self, junction=None):
+        """Recompute the curves in the track and hand them back to the
+        Run and Junction objects (as curve, leftCurve and rightCurve).
+        Given a junction, only its branches and its runs are recomputed."""
+        self.gather()
+        if junction is None:
+            runs = np.arange(len(self.runs))
+            junctions = np.arange(len(self.junctions))
+        else:
+            k = self.track.junctionIds[junction.name]
+            runs = self.junctionRunIds[k]
+            junctions = np.array([k])
+        curves = self.sample(self.controlPoints(runs, junctions))
+        nRuns = len(runs)
+        nJunctions = len(junctions)
+        for i, curve in zip(runs.tolist(), curves[:nRuns]):
+            self.runs[i].curve = curve
+        for k, left, right in zip(junctions.tolist(), curves[nRuns:nRuns + nJunctions], curves[nRuns + nJunctions:]):
+            self.junctions[k].leftCurve = left
+            self.junctions[k].rightCurve = right
+        return curves
+
+    def runLengths(self):
+        """Arc length of every run, see bezier_lengths"""
+        self.gather()
+        return bezier_lengths(self.controlPoints(junctions=np.zeros(0, dtype=np.intp)))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Counting what the layout checks do.
+
+Pass a Probe to Track.traverse or Track.findLoops and it gets one record
+per call: the number of hops along runs (each one lookup in the port
+table), decisions made at roots (traverse, with how many were random) or
+roots started from (findLoops), the reason the search stopped and the time
+it took.
+The checks count in plain local integers and only hand them over at the
+end, so with no probe there is nothing extra to pay for beyond those.
+
+For a callback on every step, subclass Probe, override hop and/or
+decision, and set trace = True. Only then are they called.
+
+@author: Dan
+"""
+
+import time
+from collections import defaultdict
+
+# why a check stopped
+COVERED = 'covered'  # traverse turned both ways at every junction
+STUCK = 'stuck'  # traverse came round a loop without any new decisions
+LOOP = 'loop'  # findLoops found a loop with no decisions in it
+NO_LOOP = 'no loop'  # findLoops checked every root and found none
+FAILED = 'failed'  # a port with nothing connected was reached, the check raised ValueError
+
+
+class Probe():
+    # collects a record of every check it is passed to, see the module
+    # docstring
+
+    trace = False
+
+    def __init__(self):
+        self.records = []
+
+    def hop(self, port, nextPort):
+        """Called for every run followed, from port to nextPort, if trace"""
+
+    def decision(self, junction, port):
+        """Called for every left/right choice at a junction's root, if trace"""
+
+    def start(self):
+        return time.perf_counter()
+
+    def finish(self, method, started, reason, **counts):
+        """Store the record of a finished check"""
+        record = {'method': method, 'reason': reason, 'seconds': time.perf_counter() - started}
+        record.update(counts)
+        self.records.append(record)
+        return record
+
+    def profile(self):
+        """Totals per method over every record: calls, seconds, each counter,
+        and how often each reason came up"""
+        totals = defaultdict(lambda: defaultdict(int))
+        for record in self.records:
+            total = totals[record['method']]
+            total['calls'] += 1
+            for key, value in record.items():
+                if key == 'reason':
+                    total[f'reason: {value}'] += 1
+                elif key != 'method':
+                    total[key] += value
+        return {method: dict(total) for method, total in totals.items()}
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing big collections of layouts.
+
+Each layout is stored as its port table (see topology.py), optionally with
+the loc, direction and swap state of every junction. There are two formats:
+
+    - binary (.layouts): a 24 byte header, then one fixed size record per
+      layout. Every layout in a file has the same number of junctions, so
+      layout i is at a known offset and the file can be memory mapped and
+      indexed without reading the rest.
+    - line delimited JSON (.jsonl): one layout per line, as
+      {"table": [...], "loc": [[x, y], ...], "direction": [...],
+      "swapped": [...]} with the geometry keys optional. Layouts can have
+      different numbers of junctions, but there is no random access.
+
+read_layouts and read_tables are generators that only hold a chunk of
+records in memory at a time, so multi-gigabyte enumeration outputs can be
+streamed through verify.verify_tables or anything else that takes port
+tables.
+
+@author: Dan
+"""
+
+import json
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from geometry import JunctionStore
+from splines import Track
+from topology import table_to_config
+
+MAGIC = b'LAYOUTS\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIII')  # magic, version, junctions, flags, reserved
+GEOMETRY = 1  # flag: records carry junction geometry
+
+LayoutRecord = namedtuple('LayoutRecord', ['table', 'loc', 'direction', 'swapped'])
+
+
+def record_dtype(nJunctions, geometry=False):
+    """numpy dtype of one record in a binary layout file"""
+    fields = [('table', '<i4', (3 * nJunctions,))]
+    if geometry:
+        fields += [('loc', '<f8', (nJunctions, 2)),
+                   ('direction', '<f8', (nJunctions,)),
+                   ('swapped', 'i1', (nJunctions,))]
+    return np.dtype(fields)
+
+
+def _is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _read_header(f):
+    magic, version, nJunctions, flags, reserved = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('Not a binary layout file')
+    if version != VERSION:
+        raise ValueError(f'Unsupported layout file version {version}')
+    return nJunctions, bool(flags & GEOMETRY)
+
+
+def _as_record(record):
+    # port tables, Tracks and LayoutRecords can all be written
+    if isinstance(record, LayoutRecord):
+        return record
+    if hasattr(record, 'portTable'):
+        store = record.store
+        return LayoutRecord(record.portTable, store.loc, store.direction, store.swapped)
+    return LayoutRecord(record, None, None, None)
+
+
+class LayoutWriter():
+    # writes layouts one at a time (or in batches) to a binary or JSON lines
+    # file, use as a context manager
+
+    def __init__(self, path, nJunctions=None, geometry=False, binary=None):
+        self.path = str(path)
+        self.binary = not self.path.endswith('.jsonl') if binary is None else binary
+        self.nJunctions = nJunctions
+        self.geometry = geometry
+        self.count = 0
+        if self.binary:
+            if nJunctions is None:
+                raise ValueError('Binary layout files need the number of junctions up front')
+            self.dtype = record_dtype(nJunctions, geometry)
+            self.file = open(self.path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, VERSION, nJunctions, GEOMETRY if geometry else 0, 0))
+        else:
+            self.file = open(self.path, 'w')
+
+    def write(self, layout):
+        """Write one layout, a port table, a Track or a LayoutRecord"""
+        self.writeMany([layout])
+
+    def writeMany(self, layouts):
+        """Write an iterable of layouts, see write"""
+        records = [_as_record(r) for r in layouts]
+        if not records:
+            return
+        if self.binary:
+            block = np.zeros(len(records), dtype=self.dtype)
+            for row, r in zip(block, records):
+                if len(r.table) != 3 * self.nJunctions:
+                    raise ValueError(f'Expected {self.nJunctions} junctions, got {len(r.table) // 3}')
+                row['table'] = r.table
+                if self.geometry:
+                    if r.loc is None:
+                        raise ValueError('This file stores geometry, but the layout has none')
+                    row['loc'] = r.loc
+                    row['direction'] = r.direction
+                    row['swapped'] = r.swapped
+            block.tofile(self.file)
+        else:
+            for r in records:
+                line = {'table': np.asarray(r.table).tolist()}
+                if self.geometry and r.loc is not None:
+                    line['loc'] = np.asarray(r.loc).tolist()
+                    line['direction'] = np.asarray(r.direction).tolist()
+                    line['swapped'] = np.asarray(r.swapped).tolist()
+                self.file.write(json.dumps(line, separators=(',', ':')) + '\n')
+        self.count += len(records)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_layouts(path, layouts, nJunctions=None, geometry=False, chunksize=10000):
+    """Write an iterable of layouts (port tables, Tracks or LayoutRecords) to
+    path, a .jsonl file or a binary one. For binary files nJunctions is
+    taken from the first layout if not given. Returns the number written."""
+    iterator = iter(layouts)
+    first = next(iterator, None)
+    if first is None and nJunctions is None:
+        nJunctions = 0
+    elif nJunctions is None:
+        nJunctions = len(_as_record(first).table) // 3
+    with LayoutWriter(path, nJunctions, geometry) as writer:
+        chunk = [] if first is None else [first]
+        for layout in iterator:
+            chunk.append(layout)
+            if len(chunk) == chunksize:
+                writer.writeMany(chunk)
+                chunk = []
+        writer.writeMany(chunk)
+        return writer.count
+
+
+def read_layouts(path, chunksize=10000):
+    """Generator of LayoutRecords from a binary or .jsonl layout file, read
+    chunksize records at a time. loc, direction and swapped are None for
+    layouts stored without geometry."""
+    if not _is_binary(path):
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                d = json.loads(line)
+                table = np.array(d['table'], dtype=np.int32)
+                if 'loc' in d:
+                    yield LayoutRecord(table, np.array(d['loc'], dtype=float),
+                                       np.array(d['direction'], dtype=float),
+                                       np.array(d['swapped'], dtype=int))
+                else:
+                    yield LayoutRecord(table, None, None, None)
+        return
+
+    with open(path, 'rb') as f:
+        nJunctions, geometry = _read_header(f)
+        dtype = record_dtype(nJunctions, geometry)
+        while True:
+            block = np.fromfile(f, dtype=dtype, count=chunksize)
+            if not len(block):
+                return
+            for row in block:
+                if geometry:
+                    yield LayoutRecord(row['table'], row['loc'], row['direction'], row['swapped'].astype(int))
+                else:
+                    yield LayoutRecord(row['table'], None, None, None)
+
+
+def read_tables(path, chunksize=10000):
+    """Generator of just the port tables in a layout file"""
+    for record in read_layouts(path, chunksize):
+        yield record.table
+
+
+class LayoutFile():
+    # random access to the layouts in a binary file through a memory map,
+    # so layout i can be read without touching the rest of the file
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, 'rb') as f:
+            self.nJunctions, self.geometry = _read_header(f)
+        self.dtype = record_dtype(self.nJunctions, self.geometry)
+        if os.path.getsize(self.path) == HEADER.size:
+            self.records = np.zeros(0, dtype=self.dtype)  # memmap can't map nothing
+        else:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode='r', offset=HEADER.size)
+
+    @property
+    def tables(self):
+        """(layouts, 3 * junctions) memory mapped array of every port table"""
+        return self.records['table']
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        row = self.records[i]
+        if self.geometry:
+            return LayoutRecord(row['table'], row['loc'], row['direction'], row['swapped'].astype(int))
+        return LayoutRecord(row['table'], None, None, None)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def record_to_track(record):
+    """Build a Track from a LayoutRecord, with its geometry if it has any.
+    Junctions are called j1, j2, ... in port table order."""
+    names = [f'j{i + 1}' for i in range(len(record.table) // 3)]
+    if record.loc is None:
+        return Track(table_to_config(record.table, names))
+    track = Track(table_to_config(record.table, names), headless=True)
+    # the Track numbers junctions by first appearance in the config,
+    # which needn't be the order of the port table
+    ids = [track.junctionIds[name] for name in names]
+    store = JunctionStore(len(names))
+    store.loc[ids] = record.loc
+    store.direction[ids] = record.direction
+    store.swapped[ids] = record.swapped
+    store.update()
+    track.buildGeometry(store)
+    track.calculateCurves()
+    return track
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+Automatic geometric layout: move, turn and flip junctions to minimise the
+total energy of the runs.
+
+Every control point of every curve in a track is a fixed offset (a, b) in
+the frame of one junction, so
+
+    P = loc + [a cos(theta) + b sin(theta), b cos(theta) - a sin(theta)]
+
+and the gradient of any energy of the curve points with respect to the
+junction positions and directions follows directly. The energy is made of
+
+    - curvature: integral of |P''(t)|^2 along each run
+    - length: integral of |P'(t)| along each run
+    - crossing: for sample points on two different curves closer than
+      `clearance`, (clearance - distance)^2, which is what stops runs
+      (and junctions) crossing or lying on top of each other
+
+Junction branches are rigid, so only their crossings count. Positions and
+directions are settled by gradient descent, moving only the junctions
+with a good share of the steepest gradient on each step and working out
+the energy again only for the curves touching them (see EnergyTerms).
+Swap states are discrete, they're settled by flipping one junction at a
+time and keeping the flip if the energy goes down.
+
+@author: Dan
+"""
+
+import numpy as np
+
+from geometry import bernstein_basis, bernstein_derivatives_at, close_point_pairs, gauss_legendre
+from topology import ROOT, LEFT, RIGHT
+
+DEFAULT_WEIGHTS = {'curvature': 1.0, 'length': 1.0, 'crossing': 10.0}
+# junctions with less than this share of the steepest gradient are left
+# where they are for a descent step, see _descend
+MOVING_SHARE = 0.1
+
+
+def _rotate(a, b, c, s):
+    # the row vector [a, b] @ rotation_matrix(direction), and its derivative
+    # with respect to the direction in radians
+    point = np.stack([a * c + b * s, b * c - a * s], axis=-1)
+    dTheta = np.stack([b * c - a * s, -b * s - a * c], axis=-1)
+    return point, dTheta
+
+
+class LayoutEnergy():
+    # energy of a track's geometry as a function of junction positions,
+    # directions (radians) and swap states, with its gradient
+
+    def __init__(self, track, weights=None, n=12, clearance=0.3):
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.n = n
+        self.clearance = clearance
+        self.basis = bernstein_basis(n)
+        # curvature and length are integrated by Gauss-Legendre quadrature,
+        # exact for the curvature and very close for the length
+        t, self.qw = gauss_legendre(8)
+        self.d1, self.d2 = bernstein_derivatives_at(t)
+
+        store = track.store
+        self.nJunctions = store.n
+        runPorts = track.geometry.runPorts
+        runScales = np.array([r.scale for r in track.runs], dtype=float)
+        self.nRuns = len(runPorts)
+        junctions = np.arange(self.nJunctions)
+
+        # every curve, runs first then left branches then right branches,
+        # as the ports at its two ends and the scale of its gradients.
+        # Branches go from the root (pointing backwards) to the tip.
+        self.curvePorts = np.concatenate([runPorts,
+                                          np.stack([3 * junctions + ROOT, 3 * junctions + LEFT], axis=1),
+                                          np.stack([3 * junctions + ROOT, 3 * junctions + RIGHT], axis=1)])
+        self.curveScales = np.concatenate([runScales, store.scale, store.scale])
+        self.curveSigns = np.concatenate([np.ones(self.nRuns), -np.ones(2 * self.nJunctions)])
+        self.nCurves = len(self.curvePorts)
+        # junction that each of the 4 control points of each curve hangs off
+        ends = self.curvePorts // 3
+        self.ctrlJunctions = ends[:, [0, 0, 1, 1]]
+        # pairs of curves touching a common junction always meet, so they
+        # can't count as crossing each other
+        self.curveJunctions = ends
+        # curves touching each junction, which all change when it's flipped
+        self.junctionCurves = [np.nonzero((ends == j).any(axis=1))[0] for j in range(self.nJunctions)]
+
+    def localCoords(self, swapped):
+        """(curves, 4) arrays a and b of every control point's offset in its
+        junction's frame, for the given swap states"""
+        ports = self.curvePorts
+        slot = ports % 3
+        sw = swapped[ports // 3]
+        side = np.where(slot == LEFT, -0.5, 0.5) * sw
+        ea = np.where(slot == ROOT, 0.0, side)
+        eb = np.where(slot == ROOT, 0.0, 1.0)
+        ga = ea
+        gb = np.where(slot == ROOT, -0.707, 0.5)
+        # runs leave and arrive along +gradient, branches are drawn from
+        # the root to the tip and use -gradient at both ends
+        k = self.curveScales * self.curveSigns
+        a = np.stack([ea[:, 0], ea[:, 0] + k * ga[:, 0], ea[:, 1] + k * ga[:, 1], ea[:, 1]], axis=1)
+        b = np.stack([eb[:, 0], eb[:, 0] + k * gb[:, 0], eb[:, 1] + k * gb[:, 1], eb[:, 1]], axis=1)
+        return a, b
+
+    def controlPoints(self, loc, theta, swapped):
+        """(curves, 4, 2) control points, and their derivatives with respect
+        to the direction of the junction they hang off"""
+        a, b = self.localCoords(swapped)
+        c = np.cos(theta)[self.ctrlJunctions]
+        s = np.sin(theta)[self.ctrlJunctions]
+        offset, dTheta = _rotate(a, b, c, s)
+        return loc[self.ctrlJunctions] + offset, dTheta
+
+    def __call__(self, loc, theta, swapped, gradient=True):
+        """Total energy, per curve energy, and optionally the gradients with
+        respect to loc (junctions, 2) and theta (junctions,)"""
+        P, dPdTheta = self.controlPoints(loc, theta, swapped)
+        gP = np.zeros_like(P)
+        perCurve = np.zeros(self.nCurves)
+        runs = slice(0, self.nRuns)
+
+        # curvature and length of the runs
+        perCurve[runs], gRuns = self.runTerms(P[runs], gradient)
+        if gradient:
+            gP[runs] += gRuns
+
+        # crossings / clearance between any two curves
+        wx = self.weights['crossing']
+        if wx:
+            X = np.matmul(self.basis, P)
+            crossing, gX = self._crossing(X, gradient)
+            perCurve += wx * crossing
+            if gradient:
+                gP += wx * np.matmul(self.basis.T, gX)
+
+        if not gradient:
+            return perCurve.sum(), perCurve, None, None
+        gLoc, gTheta = self.junctionGradients(gP, dPdTheta)
+        return perCurve.sum(), perCurve, gLoc, gTheta
+
+    def runTerms(self, P, gradient=True):
+        """Curvature plus length energy of each run with control points P
+        (runs, 4, 2), and optionally its gradient with respect to them"""
+        E = np.zeros(len(P))
+        gP = np.zeros_like(P) if gradient else None
+        wc = self.weights['curvature']
+        if wc:
+            D2 = np.matmul(self.d2, P)
+            E += wc * (D2**2).sum(axis=2) @ self.qw
+            if gradient:
+                gP += 2 * wc * np.matmul(self.d2.T, D2 * self.qw[:, None])
+        wl = self.weights['length']
+        if wl:
+            D1 = np.matmul(self.d1, P)
+            speed = np.sqrt((D1**2).sum(axis=2))
+            E += wl * speed @ self.qw
+            if gradient:
+                gP += wl * np.matmul(self.d1.T, D1 * (self.qw / np.maximum(speed, 1e-12))[:, :, None])
+        return E, gP
+
+    def junctionGradients(self, gP, dPdTheta):
+        """Chain rule from the gradient with respect to every control point
+        back to the junctions, (gLoc, gTheta)"""
+        flat = self.ctrlJunctions.ravel()
+        gLoc = np.stack([np.bincount(flat, gP[..., i].ravel(), minlength=self.nJunctions)
+                         for i in range(2)], axis=1)
+        gTheta = np.bincount(flat, (gP * dPdTheta).sum(axis=2).ravel(), minlength=self.nJunctions)
+        return gLoc, gTheta
+
+    def localEnergy(self, P, curves):
+        """Energy of some of the curves only: their curvature and length,
+        plus every crossing that involves at least one of them. The change
+        in this when a junction is flipped is the change in the total."""
+        curves = np.asarray(curves)
+        runs = curves[curves < self.nRuns]
+        E = self.runTerms(P[runs], gradient=False)[0].sum()
+        wx = self.weights['crossing']
+        if wx:
+            X = np.matmul(self.basis, P)
+            mine = X[curves].reshape(-1, 2)
+            mineCurve = np.repeat(curves, self.n)
+            # only points inside the padded bounding box of ours can be close
+            points = X.reshape(-1, 2)
+            near = np.all((points >= mine.min(axis=0) - self.clearance)
+                          & (points <= mine.max(axis=0) + self.clearance), axis=1)
+            everyCurve = np.nonzero(near)[0] // self.n
+            dist = np.sqrt(((mine[:, None, :] - points[near][None, :, :])**2).sum(axis=2))
+            ji = self.curveJunctions[mineCurve][:, None, :]
+            jj = self.curveJunctions[everyCurve][None, :, :]
+            apart = ((ji[..., 0] != jj[..., 0]) & (ji[..., 0] != jj[..., 1])
+                     & (ji[..., 1] != jj[..., 0]) & (ji[..., 1] != jj[..., 1]))
+            gap = np.where(apart, np.maximum(self.clearance - dist, 0), 0)
+            # pairs with both curves in the set are seen from both sides
+            weight = np.where(np.isin(everyCurve, curves), 0.5, 1.0)
+            E += wx * (gap**2 * weight).sum()
+        return E
+
+    def crossingPairs(self, X, radius=None, subset=None):
+        """(i, j) of every pair of the points X (curves, n, 2) closer than
+        radius, by default the clearance, on curves not touching a common
+        junction, only pairs involving the subset of the points if it's
+        given, see geometry.close_point_pairs"""
+        i, j = close_point_pairs(X.reshape(-1, 2), radius or self.clearance, subset)
+        # curves touching a common junction are allowed to meet
+        ji, jj = self.curveJunctions[i // self.n], self.curveJunctions[j // self.n]
+        apart = ((ji[:, 0] != jj[:, 0]) & (ji[:, 0] != jj[:, 1])
+                 & (ji[:, 1] != jj[:, 0]) & (ji[:, 1] != jj[:, 1]))
+        return i[apart], j[apart]
+
+    def _crossing(self, X, gradient):
+        perCurve = np.zeros(len(X))
+        gX = np.zeros_like(X) if gradient else None
+        points = X.reshape(-1, 2)
+        i, j = self.crossingPairs(X)
+        ci, cj = i // self.n, j // self.n
+
+        diff = points[i] - points[j]
+        dist = np.sqrt((diff**2).sum(axis=1))
+        gap = self.clearance - dist
+        # split each pair's energy between its two curves
+        np.add.at(perCurve, ci, gap**2 / 2)
+        np.add.at(perCurve, cj, gap**2 / 2)
+        if gradient:
+            g = (-2 * gap / np.maximum(dist, 1e-12))[:, None] * diff
+            gPoints = gX.reshape(-1, 2)
+            np.add.at(gPoints, i, g)
+            np.add.at(gPoints, j, -g)
+        return perCurve, gX
+
+
+class EnergyTerms():
+    # one layout's energy kept as the parts it's made of, so moving a few
+    # junctions only means working out the curves touching them again, as
+    # the flip pass does with LayoutEnergy.localEnergy. Each run's
+    # curvature and length are kept, and so is the crossing energy of every
+    # pair of points that was within the clearance plus three margins when
+    # either of them was last looked at. Each point is looked at again
+    # whenever it gets more than the margin from where it was last time, so
+    # since then one of a pair can have moved up to a margin and the other
+    # up to two (from a margin one side of where it was looked at to a
+    # margin the other side), and the list holds every pair that can be
+    # closer than the clearance.
+
+    def __init__(self, energy, loc, theta, swapped, margin=None):
+        self.energy = energy
+        self.loc = loc
+        self.theta = theta
+        self.swapped = swapped
+        self.margin = energy.clearance / 4 if margin is None else margin
+        self.P, self.dPdTheta = energy.controlPoints(loc, theta, swapped)
+        self.runE, self.runG = energy.runTerms(self.P[:energy.nRuns])
+        self.X = np.matmul(energy.basis, self.P)
+        self.anchor = self.X.reshape(-1, 2).copy()  # where each point was last looked at
+        if energy.weights['crossing']:
+            self.i, self.j = energy.crossingPairs(self.X, energy.clearance + 3 * self.margin)
+        else:
+            self.i = self.j = np.zeros(0, dtype=np.intp)
+        self.pairE = self._pairEnergy(self.i, self.j)
+
+    def _pairEnergy(self, i, j):
+        points = self.X.reshape(-1, 2)
+        dist = np.sqrt(((points[i] - points[j])**2).sum(axis=1))
+        return np.maximum(self.energy.clearance - dist, 0)**2
+
+    def moved(self, loc, theta, junctions):
+        """New terms with junctions (ids) moved to where loc and theta say,
+        the terms of every curve not touching them are reused"""
+        energy = self.energy
+        moving = np.zeros(energy.nJunctions, dtype=bool)
+        moving[junctions] = True
+        curves = moving[energy.curveJunctions].any(axis=1)
+        new = EnergyTerms.__new__(EnergyTerms)
+        new.energy = energy
+        new.loc = loc
+        new.theta = theta
+        new.swapped = self.swapped
+        new.margin = self.margin
+        new.P, new.dPdTheta = energy.controlPoints(loc, theta, self.swapped)
+        runs = np.nonzero(curves[:energy.nRuns])[0]
+        new.runE = self.runE.copy()
+        new.runG = self.runG.copy()
+        new.runE[runs], new.runG[runs] = energy.runTerms(new.P[runs])
+        new.X = self.X.copy()
+        new.X[curves] = np.matmul(energy.basis, new.P[curves])
+        new.anchor, new.i, new.j, new.pairE = self.anchor, self.i, self.j, self.pairE
+        if not energy.weights['crossing']:
+            return new
+        points = np.repeat(curves, energy.n)
+        # points that have strayed too far are paired up again from scratch
+        strayed = np.zeros_like(points)
+        strayed[points] = ((new.X.reshape(-1, 2)[points] - self.anchor[points])**2).sum(axis=1) > self.margin**2
+        if strayed.any():
+            kept = ~(strayed[self.i] | strayed[self.j])
+            i, j = energy.crossingPairs(new.X, energy.clearance + 3 * self.margin, strayed)
+            new.i = np.concatenate([self.i[kept], i])
+            new.j = np.concatenate([self.j[kept], j])
+            new.pairE = np.concatenate([self.pairE[kept], np.zeros(len(i))])
+            new.anchor = self.anchor.copy()
+            new.anchor[strayed] = new.X.reshape(-1, 2)[strayed]
+        else:
+            new.pairE = self.pairE.copy()
+        changed = points[new.i] | points[new.j]
+        new.pairE[changed] = new._pairEnergy(new.i[changed], new.j[changed])
+        return new
+
+    def total(self):
+        """Total energy"""
+        return self.runE.sum() + self.energy.weights['crossing'] * self.pairE.sum()
+
+    def perCurve(self):
+        """Energy of each curve, as LayoutEnergy gives it"""
+        energy = self.energy
+        perCurve = np.zeros(energy.nCurves)
+        perCurve[:energy.nRuns] = self.runE
+        # split each pair's energy between its two curves
+        perCurve += energy.weights['crossing'] * np.bincount(
+            np.r_[self.i, self.j] // energy.n, np.r_[self.pairE, self.pairE] / 2, minlength=energy.nCurves)
+        return perCurve
+
+    def gradient(self):
+        """(gLoc, gTheta) of the total energy"""
+        energy = self.energy
+        gP = np.zeros_like(self.P)
+        gP[:energy.nRuns] = self.runG
+        wx = energy.weights['crossing']
+        if wx:
+            close = self.pairE > 0
+            i, j = self.i[close], self.j[close]
+            points = self.X.reshape(-1, 2)
+            diff = points[i] - points[j]
+            dist = np.sqrt((diff**2).sum(axis=1))
+            g = (-2 * (energy.clearance - dist) / np.maximum(dist, 1e-12))[:, None] * diff
+            index = np.r_[i, j]
+            gPoints = np.stack([np.bincount(index, np.r_[g[:, k], -g[:, k]], minlength=len(points))
+                                for k in range(2)], axis=1)
+            gP += wx * np.matmul(energy.basis.T, gPoints.reshape(self.X.shape))
+        return energy.junctionGradients(gP, self.dPdTheta)
+
+
+def optimize_layout(track, weights=None, n=12, clearance=0.3, maxIter=500, tol=1e-5,
+                    swapRounds=2, log=False):
+    """Minimise the run energy of a track over junction positions,
+    directions and swap states, in place
+
+    Gradient descent with a backtracking line search over positions and
+    directions, then one pass of flipping each junction, repeated
+    swapRounds times. The junction store is updated at the end and each
+    run's share of the energy is left in Run.cost.
+
+    Returns the final total energy.
+    """
+    energy = LayoutEnergy(track, weights, n, clearance)
+    store = track.store
+    loc = store.loc.copy()
+    theta = np.deg2rad(store.direction)
+    swapped = store.swapped.copy()
+
+    for swapRound in range(swapRounds + 1):
+        loc, theta, E = _descend(energy, loc, theta, swapped, maxIter, tol, log)
+        if swapRound == swapRounds:
+            break
+        # try flipping each junction in turn, only the curves touching
+        # it change so only their share of the energy needs working out
+        flipped = False
+        P = energy.controlPoints(loc, theta, swapped)[0]
+        for j in range(store.n):
+            curves = energy.junctionCurves[j]
+            before = energy.localEnergy(P, curves)
+            swapped[j] *= -1
+            trialP = energy.controlPoints(loc, theta, swapped)[0]
+            after = energy.localEnergy(trialP, curves)
+            if after < before:
+                E += after - before
+                P = trialP
+                flipped = True
+                if log:
+                    print(f'Flipping {track.junctionNames[j]}, energy = {E:.4g}')
+            else:
+                swapped[j] *= -1
+        if not flipped:
+            break
+
+    store.loc[:] = loc
+    store.direction[:] = np.rad2deg(theta) % 360
+    store.swapped[:] = swapped
+    store.update()
+    E, perCurve, _, _ = energy(loc, theta, swapped, gradient=False)
+    for r, cost in zip(track.runs, perCurve):
+        r.cost = float(cost)
+    return E
+
+
+def _descend(energy, loc, theta, swapped, maxIter, tol, log):
+    terms = EnergyTerms(energy, loc, theta, swapped)
+    E = terms.total()
+    gLoc, gTheta = terms.gradient()
+    step = 0.1
+    everything = True
+    for iteration in range(maxIter):
+        # only junctions with a good share of the steepest gradient move, so
+        # only the curves touching them need working out again. Every
+        # junction moves once the others stop getting anywhere.
+        gJunction = np.sqrt((gLoc**2).sum(axis=1) + gTheta**2)
+        if gJunction.max() == 0:
+            break
+        moving = gJunction >= (0.0 if everything else MOVING_SHARE) * gJunction.max()
+        junctions = np.nonzero(moving)[0]
+        gLocMoving = np.where(moving[:, None], gLoc, 0.0)
+        gThetaMoving = np.where(moving, gTheta, 0.0)
+        gNorm2 = (gLocMoving**2).sum() + (gThetaMoving**2).sum()
+        # backtrack until the energy goes down enough (Armijo condition)
+        while True:
+            newLoc = loc - step * gLocMoving
+            newTheta = theta - step * gThetaMoving
+            trial = terms.moved(newLoc, newTheta, junctions)
+            newE = trial.total()
+            if newE <= E - 1e-4 * step * gNorm2 or step < 1e-12:
+                break
+            step *= 0.5
+        if newE >= E:
+            if everything:
+                break
+            everything = True
+            step = 0.1
+            continue
+        improvement = E - newE
+        loc, theta, terms, E = newLoc, newTheta, trial, newE
+        gLoc, gTheta = terms.gradient()
+        if log and iteration % 50 == 0:
+            print(f'iteration {iteration}: energy = {E:.4g}')
+        if improvement < tol * max(E, 1e-12):
+            break
+        everything = False
+        step *= 2  # be a bit braver next time
+    return loc, theta, E
+
+
+if __name__ == "__main__":
+    from sampling import sample_tables
+    from splines import Track
+    from topology import table_to_config
+
+    # the terms kept by EnergyTerms, moved a few junctions at a time, have
+    # to add up to the same energy and gradient as working it all out again
+    rng = np.random.default_rng(0)
+    track = Track(table_to_config(sample_tables(40, 1, good=True, rng=0)[0]), seed=0)
+    energy = LayoutEnergy(track)
+    store = track.store
+    loc, theta, swapped = store.loc.copy(), np.deg2rad(store.direction), store.swapped.copy()
+    terms = EnergyTerms(energy, loc, theta, swapped)
+    for step in range(300):
+        junctions = rng.choice(store.n, 10, replace=False)
+        loc, theta = loc.copy(), theta.copy()
+        loc[junctions] += rng.normal(0, 0.03, (10, 2))
+        theta[junctions] += rng.normal(0, 0.03, 10)
+        terms = terms.moved(loc, theta, junctions)
+        E, perCurve, gLoc, gTheta = energy(loc, theta, swapped)
+        assert np.isclose(terms.total(), E, rtol=1e-12, atol=0), (step, terms.total(), E)
+        assert np.allclose(terms.perCurve(), perCurve, rtol=1e-9, atol=1e-12)
+        assert all(np.allclose(a, b, rtol=1e-9, atol=1e-9) for a, b in zip(terms.gradient(), (gLoc, gTheta)))
+    print(f'EnergyTerms matches LayoutEnergy after {step + 1} moves, energy {E:.6g}')
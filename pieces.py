@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+Building runs out of real track pieces.
+
+Toy track comes as a few fixed pieces, straights of a set length and curves
+of a set radius and angle, rather than the free Bezier curves the editor
+draws. quantize_track replaces every run by a chain of pieces from a
+library that starts at the run's start port, pointing along its gradient
+(Junction.endpoints and Junction.gradients), and ends as close as it can
+get to its end port, pointing into it.
+
+Each run is solved by dynamic programming over the pose of the end of the
+chain, (x, y, heading), cut into bins resolution wide and 360 /
+headingBins degrees round. Layer k holds every bin reachable with k
+pieces that no shorter chain reached, so each bin is only expanded once,
+by its shortest chain, and each layer is worked out for all its states at
+once with numpy. The search stops at the first layer with a chain whose
+end is within gapTolerance of the end port and headingTolerance of its
+heading, so it finds the fewest pieces that fit, or else gives the chain
+that got closest. The search is run allowing one more piece at a time,
+from the fewest that could reach the end port, and states that couldn't
+get there with the pieces left, even going straight for it with the
+longest piece or turning for it with the sharpest curve, are dropped. So
+are states further than corridor from the run's curve if one is given,
+which keeps the chain following the layout as drawn.
+
+Solutions only depend on the run's shape relative to its start, so they're
+kept by that shape, rounded to the bins, and runs with the same shape
+(every reversing loop with the same scale, say) are only solved once.
+
+For every run the result gives the pieces, the gap and the heading error
+left at the end port (the closure gap), whether those are within the
+solver's tolerances, and the furthest the chain strays from the run's
+curve (the fit error). Runs that don't fit still get the chain that came
+closest, unless quantize_track is told to be strict.
+
+@author: Dan
+"""
+
+import math
+from collections import Counter, namedtuple
+
+import numpy as np
+
+from geometry import bezier_cubics, bezier_lengths
+
+# angle in degrees, positive turns left, length along the track
+Piece = namedtuple('Piece', ['name', 'length', 'angle'])
+
+
+def curve(name, radius, angle):
+    """A curved piece of radius turning angle degrees, left if positive"""
+    return Piece(name, radius * math.radians(abs(angle)), angle)
+
+
+# in layout units, where a junction is about 1 long
+DEFAULT_LIBRARY = (Piece('straight', 1.0, 0.0),
+                   Piece('half straight', 0.5, 0.0),
+                   Piece('quarter straight', 0.25, 0.0),
+                   curve('left curve', 1.5, 45.0),
+                   curve('right curve', 1.5, -45.0),
+                   curve('short left curve', 1.5, 22.5),
+                   curve('short right curve', 1.5, -22.5))
+
+
+def piece_steps(library, heading):
+    """(dx, dy, dHeading) of every piece in library, (poses, pieces) arrays,
+    starting from each heading (radians)"""
+    heading = np.asarray(heading, dtype=float)[:, None]
+    length = np.array([p.length for p in library])
+    turn = np.radians([p.angle for p in library])
+    straight = turn == 0
+    # where each piece ends in its own frame, an arc of radius length /
+    # turn or a straight line, then turned to each heading
+    radius = np.where(straight, 0.0, length / np.where(straight, 1.0, turn))
+    forward = np.where(straight, length, radius * np.sin(turn))
+    side = radius * (1 - np.cos(turn))
+    c = np.cos(heading)
+    s = np.sin(heading)
+    return c * forward - s * side, s * forward + c * side, np.broadcast_to(turn, (len(c), len(turn)))
+
+
+def piece_points(library, poses, pieces, n=8):
+    """(len(pieces) * n, 2) points along a chain of pieces, poses being the
+    (x, y, heading) at the start of each"""
+    t = np.linspace(0, 1, n)
+    points = []
+    for (x, y, h), i in zip(poses, pieces):
+        piece = library[i]
+        sub = [Piece(piece.name, piece.length * s, piece.angle * s) for s in t]
+        dx, dy, _ = piece_steps(sub, [h])
+        points.append(np.stack([x + dx[0], y + dy[0]], axis=1))
+    return np.concatenate(points) if points else np.zeros((0, 2))
+
+
+def _wrap(angle):
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+class RunPieces():
+    # the chain of pieces standing in for one run
+
+    def __init__(self, run, pieces, poses, gap, headingError, fitError, fits):
+        self.run = run
+        self.pieces = pieces  # names, from the start port
+        self.poses = poses  # (pieces + 1, 3) x, y, heading (radians) along the chain
+        self.gap = gap  # distance from the end of the chain to the end port
+        self.headingError = headingError  # degrees
+        self.fitError = fitError  # furthest the chain gets from the run's curve
+        self.fits = fits  # gap and heading error within the solver's tolerances
+
+    def __repr__(self):
+        return (f'{self.run}: {len(self.pieces)} pieces, gap {self.gap:.3g}, heading {self.headingError:.3g} deg'
+                + ('' if self.fits else ", doesn't fit"))
+
+
+class LayoutPieces():
+    # every run of a track as pieces, see quantize_track
+
+    def __init__(self, runs):
+        self.runs = runs  # run name: RunPieces
+
+    @property
+    def closureGap(self):
+        """Largest gap left at the end of any run"""
+        return max((r.gap for r in self.runs.values()), default=0.0)
+
+    @property
+    def headingError(self):
+        return max((r.headingError for r in self.runs.values()), default=0.0)
+
+    @property
+    def fitError(self):
+        return max((r.fitError for r in self.runs.values()), default=0.0)
+
+    def misfits(self):
+        """Runs whose chains miss their end port by more than the
+        tolerances"""
+        return [r for r in self.runs.values() if not r.fits]
+
+    def counts(self):
+        """How many of each piece the layout needs"""
+        return Counter(name for r in self.runs.values() for name in r.pieces)
+
+    def __str__(self):
+        counts = ', '.join(f'{n} x {name}' for name, n in sorted(self.counts().items()))
+        return (f'{len(self.runs)} runs, {sum(self.counts().values())} pieces ({counts}): '
+                f'closure gap {self.closureGap:.3g}, heading error {self.headingError:.3g} deg, '
+                f'fit error {self.fitError:.3g}, {len(self.misfits())} runs don\'t fit')
+
+
+class PieceSolver():
+    # finds chains of pieces between two poses, remembering every solution
+    # by the shape of the run it was for, see the module docstring
+
+    def __init__(self, library=DEFAULT_LIBRARY, resolution=0.05, headingBins=72, gapTolerance=None,
+                 headingTolerance=None, headingWeight=1.0, corridor=None, maxPieces=None):
+        """
+        Parameters
+        ----------
+        library : sequence of Piece
+        resolution : float
+            width of the position bins, in layout units
+        headingBins : int
+            number of heading bins in a full turn
+        gapTolerance : float or None
+            a chain fits once its end is this close to the end port, by
+            default half the shortest piece
+        headingTolerance : float or None
+            and it points within this many degrees of the end port's
+            heading, by default half the gentlest curve
+        headingWeight : float
+            weight of the heading error (in radians) against the gap when
+            picking the closest chain, for runs where none fits
+        corridor : float or None
+            how far from the run's curve the chain can go, to the nearest
+            bin, None for anywhere
+        maxPieces : int or None
+            most pieces in one run, by default enough for twice the run's
+            length in the longest piece, plus 8
+        """
+        self.library = tuple(library)
+        self.resolution = resolution
+        self.headingBins = headingBins
+        if gapTolerance is None:
+            gapTolerance = min(p.length for p in self.library) / 2
+        if headingTolerance is None:
+            headingTolerance = min((abs(p.angle) for p in self.library if p.angle),
+                                   default=360 / headingBins) / 2
+        self.gapTolerance = gapTolerance
+        self.headingTolerance = headingTolerance
+        self.headingWeight = headingWeight
+        self.corridor = corridor
+        self.maxPieces = maxPieces
+        self.longest = max(p.length for p in self.library)
+        self.sharpest = max(math.radians(abs(p.angle)) for p in self.library)
+        self.cache = {}
+
+    def solve(self, control):
+        """Pieces for the run with these (4, 2) Bezier control points, from
+        control[0] heading towards control[1] to control[3] heading in from
+        control[2]
+
+        Returns (piece ids, poses), poses in layout coordinates.
+        """
+        control = np.asarray(control, dtype=float)
+        start = control[0]
+        h0 = math.atan2(*(control[1] - control[0])[::-1])
+        # the run in the frame of its start, which is all the solution
+        # depends on
+        c, s = math.cos(h0), math.sin(h0)
+        local = (control - start) @ np.array([[c, -s], [s, c]])
+        key = tuple(np.round(local[1:] / self.resolution).astype(int).ravel().tolist())
+        if key not in self.cache:
+            self.cache[key] = self._search(local)
+        pieces, poses = self.cache[key]
+        # back to layout coordinates
+        xy = poses[:, :2] @ np.array([[c, s], [-s, c]]) + start
+        return pieces, np.column_stack([xy, poses[:, 2] + h0])
+
+    def _search(self, control):
+        # fewest pieces from (0, 0) heading 0 to the end of the run
+        target = control[3]
+        th = math.atan2(*(control[3] - control[2])[::-1])
+        samples = bezier_cubics(control[None], 64)[0]
+        maxPieces = self.maxPieces
+        if maxPieces is None:
+            maxPieces = int(2 * bezier_lengths(control[None])[0] / self.longest) + 8
+        hWidth = 2 * np.pi / self.headingBins
+        if self.corridor is not None:
+            # which bins are within the corridor of the curve, to the
+            # nearest bin
+            lo = samples.min(axis=0) - self.corridor
+            hi = samples.max(axis=0) + self.corridor
+            gx = np.arange(lo[0], hi[0] + self.resolution, self.resolution) + self.resolution / 2
+            gy = np.arange(lo[1], hi[1] + self.resolution, self.resolution) + self.resolution / 2
+            inside = np.zeros((len(gx), len(gy)), dtype=bool)
+            for i in range(len(gx)):
+                d = np.hypot(gx[i] - samples[:, 0], gy[:, None] - samples[:, 1])
+                inside[i] = d.min(axis=1) <= self.corridor
+
+        def keys(x, y, h):
+            ix = np.floor(x / self.resolution).astype(np.int64) + (1 << 20)
+            iy = np.floor(y / self.resolution).astype(np.int64) + (1 << 20)
+            ih = np.floor((h % (2 * np.pi)) / hWidth).astype(np.int64) % self.headingBins
+            return (ix << 21 | iy) * self.headingBins + ih
+
+        headingTolerance = math.radians(self.headingTolerance)
+
+        def cost(x, y, h):
+            gap = np.hypot(x - target[0], y - target[1])
+            return gap + self.headingWeight * np.abs(_wrap(h - th))
+
+        def fewest(x, y, h):
+            # fewer pieces than this can't close the gap, or turn to the
+            # end port's heading
+            gap = np.hypot(x - target[0], y - target[1]) - self.gapTolerance
+            turn = np.abs(_wrap(h - th)) - headingTolerance
+            turns = np.inf if self.sharpest == 0 else np.ceil(turn / self.sharpest)
+            return np.maximum(np.ceil(gap / self.longest), np.where(turn > 0, turns, 0))
+
+        def fits(x, y, h):
+            return ((np.hypot(x - target[0], y - target[1]) <= self.gapTolerance)
+                    & (np.abs(_wrap(h - th)) <= headingTolerance))
+
+        def chains(limit):
+            # layers of states of chains that could still fit in limit
+            # pieces, the best state (cost, layer, index) and whether it fits
+            x = np.zeros(1)
+            y = np.zeros(1)
+            h = np.zeros(1)
+            seen = keys(x, y, h)
+            layers = [(x, y, h, None, None)]
+            best = (cost(x, y, h)[0], 0, 0)
+            for k in range(1, limit + 1):
+                dx, dy, dh = piece_steps(self.library, h)
+                x = (x[:, None] + dx).ravel()
+                y = (y[:, None] + dy).ravel()
+                h = (h[:, None] + dh).ravel()
+                parent = np.repeat(np.arange(len(dx)), nPieces)
+                piece = np.tile(np.arange(nPieces), len(dx))
+                # drop chains that can't reach the end port with the pieces
+                # left, or stray too far from the curve
+                keep = fewest(x, y, h) <= limit - k
+                if self.corridor is not None:
+                    ix = np.floor((x - lo[0]) / self.resolution).astype(np.intp)
+                    iy = np.floor((y - lo[1]) / self.resolution).astype(np.intp)
+                    valid = (ix >= 0) & (ix < inside.shape[0]) & (iy >= 0) & (iy < inside.shape[1])
+                    keep[valid] &= inside[ix[valid], iy[valid]]
+                    keep &= valid
+                # one state per bin, and only bins no shorter chain got to
+                binKeys, first = np.unique(keys(x[keep], y[keep], h[keep]), return_index=True)
+                at = np.minimum(np.searchsorted(seen, binKeys), len(seen) - 1)
+                new = seen[at] != binKeys
+                index = np.nonzero(keep)[0][first[new]]
+                if not len(index):
+                    break
+                # both sorted, which a stable sort merges in one pass
+                seen = np.sort(np.concatenate([seen, binKeys[new]]), kind='stable')
+                x, y, h, parent, piece = x[index], y[index], h[index], parent[index], piece[index]
+                layers.append((x, y, h, parent, piece))
+                costs = cost(x, y, h)
+                fit = fits(x, y, h)
+                if fit.any():
+                    # the first layer to fit has the fewest pieces
+                    i = int(np.where(fit, costs, np.inf).argmin())
+                    return layers, (costs[i], k, i), True
+                i = int(costs.argmin())
+                if costs[i] < best[0]:
+                    best = (costs[i], k, i)
+            return layers, best, False
+
+        # more pieces each time until a chain fits, the fewer pieces allowed
+        # the more states fewest rules out
+        nPieces = len(self.library)
+        closest = None
+        for limit in range(max(int(fewest(0.0, 0.0, 0.0)), 1), maxPieces + 1):
+            layers, best, fitted = chains(limit)
+            if closest is None or best[0] < closest[1][0]:
+                closest = (layers, best)
+            if fitted:
+                closest = (layers, best)
+                break
+        layers, best = closest
+
+        # follow the parents back from the best state
+        _, k, i = best
+        pieces = []
+        poses = []
+        while k > 0:
+            x, y, h, parent, piece = layers[k]
+            poses.append((x[i], y[i], h[i]))
+            pieces.append(int(piece[i]))
+            i = int(parent[i])
+            k -= 1
+        poses.append((0.0, 0.0, 0.0))
+        return pieces[::-1], np.array(poses[::-1])
+
+
+def quantize_track(track, solver=None, strict=False, **kwargs):
+    """Every run of a track as a chain of pieces, see the module docstring
+
+    solver is a PieceSolver, made from kwargs if not given. Reusing one
+    solver between tracks reuses its solutions too. With strict, a run that
+    can't be made to fit within the solver's tolerances raises a
+    ValueError, otherwise it's flagged (RunPieces.fits,
+    LayoutPieces.misfits).
+
+    Returns a LayoutPieces.
+    """
+    solver = solver or PieceSolver(**kwargs)
+    library = solver.library
+    results = {}
+    for r in track.runs:
+        control = r.controlPoints()
+        pieces, poses = solver.solve(control)
+        end = poses[-1]
+        heading = math.atan2(*(control[3] - control[2])[::-1])
+        chain = piece_points(library, poses[:-1], pieces)
+        curvePoints = bezier_cubics(control[None], 200)[0]
+        if len(chain):
+            fitError = float(np.hypot(*(chain[:, None, :] - curvePoints[None]).transpose(2, 0, 1)).min(axis=1).max())
+        else:
+            fitError = 0.0
+        gap = float(np.hypot(*(end[:2] - control[3])))
+        headingError = float(abs(math.degrees(_wrap(end[2] - heading))))
+        fits = gap <= solver.gapTolerance and headingError <= solver.headingTolerance
+        if strict and not fits:
+            raise ValueError(f'No chain of pieces fits run {r.name}, the closest misses by '
+                             f'{gap:.3g} and {headingError:.3g} deg')
+        results[r.name] = RunPieces(r, [library[i].name for i in pieces], poses, gap, headingError,
+                                    fitError, fits)
+    return LayoutPieces(results)
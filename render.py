@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Drawing many layouts to image files, without the editor.
+
+Track.draw makes one plot per curve plus pickable markers for every
+junction, which the editor needs but is far too slow for drawing a whole
+catalogue. Here every curve on a sheet is drawn with one LineCollection per
+style, the same styles as the editor (runs blue, left branches red, right
+branches dashed red), on a Figure that never goes near pyplot or a GUI.
+Many layouts are tiled onto each sheet, every one scaled to fit its cell,
+and the file name says whether it's saved as PNG or SVG. render_catalogue
+spreads the sheets over a process pool.
+
+    render_catalogue(enumerate_tables(8), 'catalogue/n8_{:04d}.png')
+
+Layouts can be Tracks, run configs, port tables or layoutfile.LayoutRecords.
+Anything without geometry gets junctions placed at random, from seed plus
+its position in the catalogue, so a catalogue comes out the same every
+time whichever sheet or process draws it.
+
+@author: Dan
+"""
+
+import argparse
+import math
+import os
+from functools import partial
+
+import numpy as np
+
+from geometry import bezier_cubics
+from layoutfile import LayoutRecord, read_layouts, record_to_track
+from splines import Track
+from topology import table_to_config
+from verify import map_chunks
+
+STYLES = {'run': {'colors': 'b', 'linewidths': 1.0},
+          'left': {'colors': 'r', 'linewidths': 1.0},
+          'right': {'colors': 'r', 'linewidths': 1.0, 'linestyles': '--'}}
+
+
+def as_track(layout, seed=None):
+    """A Track for any kind of layout (see the module docstring), placed at
+    random from seed if it doesn't come with geometry"""
+    if isinstance(layout, Track):
+        return layout
+    if isinstance(layout, LayoutRecord):
+        if layout.loc is not None:
+            return record_to_track(layout)
+        layout = layout.table
+    if isinstance(layout, dict):
+        return Track(layout, headless=True, seed=seed)
+    return Track(table_to_config(np.asarray(layout)), headless=True, seed=seed)
+
+
+def layout_curves(track, n=32):
+    """{style: (curves, n, 2) array} of every curve in a track, sampled
+    with n points each, see STYLES"""
+    geometry = track.geometry
+    geometry.gather()
+    curves = bezier_cubics(geometry.controlPoints(), n)
+    nRuns = len(geometry.runs)
+    nJunctions = len(geometry.junctions)
+    return {'run': curves[:nRuns],
+            'left': curves[nRuns:nRuns + nJunctions],
+            'right': curves[nRuns + nJunctions:]}
+
+
+def render_sheet(layouts, path, columns=None, cellSize=1.5, labels=None, seed=0, n=32,
+                 optimize=False, dpi=100):
+    """Draw layouts tiled on one sheet and save it to path
+
+    Parameters
+    ----------
+    layouts : list of Tracks, run configs, port tables or LayoutRecords
+    path : str, ending .png or .svg (or anything else matplotlib can save)
+    columns : int, by default enough to make the sheet about square
+    cellSize : float
+        size of each layout's cell in inches
+    labels : list of str, one per layout, drawn in the corner of its cell
+    seed : int
+        layout i without geometry is placed at random from seed + i
+    n : int
+        points per curve
+    optimize : bool
+        tidy up each layout with Track.optimize first, slow but much easier
+        to read than random placement. Tracks passed in are copied first,
+        never changed.
+
+    Returns the path.
+    """
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+
+    count = len(layouts)
+    columns = columns or max(math.ceil(math.sqrt(count)), 1)
+    rows = max(math.ceil(count / columns), 1)
+    styled = {style: [] for style in STYLES}
+    for i, layout in enumerate(layouts):
+        track = as_track(layout, seed + i)
+        if optimize:
+            if track is layout:
+                track = track.copy()  # the caller's Track is left as it was
+            track.optimize()
+        curves = layout_curves(track, n)
+        points = np.concatenate([c.reshape(-1, 2) for c in curves.values()])
+        lo = points.min(axis=0)
+        hi = points.max(axis=0)
+        # fit the layout into 90% of its cell, row 0 at the top
+        scale = 0.9 / max((hi - lo).max(), 1e-9)
+        row, column = divmod(i, columns)
+        offset = np.array([column + 0.5, rows - row - 0.5]) - scale * (lo + hi) / 2
+        for style, c in curves.items():
+            styled[style].append(c * scale + offset)
+
+    fig = Figure(figsize=(columns * cellSize, rows * cellSize))
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    for style, curves in styled.items():
+        if curves:
+            ax.add_collection(LineCollection(np.concatenate(curves), **STYLES[style]))
+    if labels is not None:
+        for i, label in enumerate(labels):
+            row, column = divmod(i, columns)
+            ax.text(column + 0.03, rows - row - 0.03, label, fontsize=6, va='top')
+    ax.set_xlim(0, columns)
+    ax.set_ylim(0, rows)
+    ax.set_aspect('equal')
+    directory = os.path.dirname(str(path))
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fig.savefig(path, dpi=dpi)
+    return path
+
+
+def _render_chunk(items, pattern, perSheet, seed=0, **kwargs):
+    # one sheet from a chunk of (position in the catalogue, layout) pairs
+    positions, layouts = zip(*items)
+    path = pattern.format(positions[0] // perSheet)
+    return [render_sheet(list(layouts), path, labels=[str(i) for i in positions],
+                         seed=seed + positions[0], **kwargs)]
+
+
+def render_catalogue(layouts, pattern, perSheet=100, workers=None, **kwargs):
+    """Draw any number of layouts onto sheets of perSheet each, over a
+    process pool
+
+    Sheet k is saved to pattern.format(k), e.g. 'catalogue/n8_{:04d}.svg',
+    and each layout is labelled with its position in the catalogue. layouts
+    can be any iterable, e.g. enumeration.enumerate_tables or
+    layoutfile.read_layouts, it's only read a few sheets ahead of the
+    workers. workers is as for verify.verify_many, and the rest of the
+    arguments are passed on to render_sheet.
+
+    Returns the list of paths written.
+    """
+    function = partial(_render_chunk, pattern=pattern, perSheet=perSheet, **kwargs)
+    return list(map_chunks(function, enumerate(layouts), workers, perSheet))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Draw a catalogue of layouts')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--junctions', type=int, help='draw every layout with this many junctions')
+    source.add_argument('--file', help='draw the layouts in a layout file, see layoutfile.py')
+    parser.add_argument('--good', action='store_true', help='only draw good layouts')
+    parser.add_argument('--output', default='catalogue/sheet_{:04d}.png',
+                        help='file name pattern for the sheets')
+    parser.add_argument('--per-sheet', type=int, default=100)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--optimize', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.junctions is not None:
+        from enumeration import enumerate_tables
+        layouts = enumerate_tables(args.junctions)
+    else:
+        layouts = read_layouts(args.file)
+    if args.good:
+        from topology import is_good
+        layouts = (layout for layout in layouts
+                   if is_good(layout.table if isinstance(layout, LayoutRecord) else layout))
+    paths = render_catalogue(layouts, args.output, args.per_sheet, args.workers,
+                             seed=args.seed, optimize=args.optimize)
+    print(f'{len(paths)} sheets written')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Turn a bad layout into a good one with as few edits as possible.
+
+Two kinds of edit are tried:
+
+    - a reversing loop, as in the README: a new junction C is spliced into
+      an existing run with its root facing port p, and its right branch
+      leads to a second new junction D whose left and right are joined in
+      a loop. A train leaving p can now turn round and come back to p.
+    - a rewire: two runs swap one of their ends, (a, b) and (c, d) become
+      (a, c) and (b, d), or (a, d) and (b, c)
+
+A layout is good when its state graph (see topology.check_table) is one
+strongly connected component. Otherwise there is at least one sink
+component a train can't leave, and any repair has to change some move
+out of it. So the search always picks one sink and only tries edits
+touching it, and it searches depth first with an increasing number of
+edits, so the first repair found is one of the smallest. An edit changes
+at most four moves, so a layout with k sinks (or k sources) can't be
+fixed with fewer than k / 4 edits, or k reversing loops. On the last
+edit, only edits that reach every sink and every source are checked.
+
+@author: Dan
+"""
+
+import numpy as np
+
+from topology import (ROOT, LEFT, RIGHT, IN, OUT, PORT_NAMES, PORT_INDEX,
+                      state_successors, strongly_connected_components)
+
+
+def condensation(table):
+    """Strongly connected components of the state graph of a port table
+
+    Returns
+    -------
+    componentOf : list of int
+        component id of every state
+    sinks : list of int
+        ids of the components that can't be left
+    sources : list of int
+        ids of the components that can't be entered
+    """
+    succ = state_successors(table)
+    componentOf = [0] * len(succ)
+    nComponents = 0
+    for component in strongly_connected_components(succ):
+        for s in component:
+            componentOf[s] = nComponents
+        nComponents += 1
+    hasExit = [False] * nComponents
+    hasEntry = [False] * nComponents
+    for s, targets in enumerate(succ):
+        for t in targets:
+            if componentOf[s] != componentOf[t]:
+                hasExit[componentOf[s]] = True
+                hasEntry[componentOf[t]] = True
+    sinks = [c for c in range(nComponents) if not hasExit[c]]
+    sources = [c for c in range(nComponents) if not hasEntry[c]]
+    return componentOf, sinks, sources
+
+
+def add_reversing_loop(table, port):
+    """New table with a reversing loop spliced into the run leaving port,
+    with the new junctions numbered after the existing ones"""
+    table = list(table)
+    other = table[port]
+    c = len(table)  # root of the spliced in junction
+    d = c + 3  # root of the loop junction
+    table.extend([-1] * 6)
+    for a, b in ((port, c + ROOT), (c + LEFT, other), (c + RIGHT, d + ROOT), (d + LEFT, d + RIGHT)):
+        table[a] = b
+        table[b] = a
+    return table
+
+
+def rewire(table, a, c, d):
+    """New table with the runs (a, b) and (c, d) replaced by (a, c) and (b, d)"""
+    table = list(table)
+    b = table[a]
+    for p, q in ((a, c), (b, d)):
+        table[p] = q
+        table[q] = p
+    return table
+
+
+def repair_table(table, maxEdits=4, rewires=True):
+    """Smallest set of edits that turns a layout good
+
+    Parameters
+    ----------
+    table : port table, every port connected
+    maxEdits : int
+        give up if it takes more edits than this
+    rewires : bool
+        allow rewiring runs as well as adding reversing loops
+
+    Returns
+    -------
+    (table, edits), with the repaired table and a list of edits, each
+    ('loop', port) or ('rewire', a, c, d) as in add_reversing_loop and
+    rewire, applied in order. None if nothing within maxEdits works.
+    """
+    table = np.asarray(table).tolist()
+    if -1 in table:
+        raise ValueError('Every port needs to be connected before a layout can be repaired')
+    for depth in range(maxEdits + 1):
+        result = _search(table, depth, rewires)
+        if result is not None:
+            return result
+    return None
+
+
+def _search(table, depth, rewires):
+    componentOf, sinks, sources = condensation(table)
+    if len(sinks) == 1 and len(sources) == 1 and sinks == sources:
+        return table, []  # a single component, the layout is good
+    if depth == 0:
+        return None
+    perEdit = 4 if rewires else 1
+    if max(len(sinks), len(sources)) > depth * perEdit:
+        return None
+    last = depth == 1
+    sinkSet = set(sinks)
+    sourceSet = set(sources)
+
+    def reaches(tails, heads):
+        # on the last edit, the new moves have to leave every sink and
+        # enter every source, or there's no point checking it
+        return (sinkSet <= {componentOf[2 * p + OUT] for p in tails}
+                and sourceSet <= {componentOf[2 * p + IN] for p in heads})
+
+    # ports whose outgoing move starts in the first sink, one of them
+    # has to be changed
+    sink = sinks[0]
+    tails = [p for p in range(len(table)) if componentOf[2 * p + OUT] == sink]
+
+    for p in tails:
+        if last and not reaches([p], [p]):
+            continue
+        result = _search(add_reversing_loop(table, p), depth - 1, rewires)
+        if result is not None:
+            return result[0], [('loop', p)] + result[1]
+
+    if not rewires:
+        return None
+    for a in tails:
+        b = table[a]
+        for c in range(len(table)):
+            d = table[c]
+            if c in (a, b):
+                continue
+            if last and not reaches([a, b, c, d], [a, b, c, d]):
+                continue
+            result = _search(rewire(table, a, c, d), depth - 1, rewires)
+            if result is not None:
+                return result[0], [('rewire', a, c, d)] + result[1]
+    return None
+
+
+def repair_track(track, maxEdits=4, rewires=True):
+    """Repair a Track's layout, see repair_table
+
+    Returns (config, edits) with a run config for the repaired layout that
+    Track accepts, or None. Junctions and runs that are unchanged keep
+    their names, new junctions are called fix1, fix2, ... and new runs get
+    names not used in the old config.
+    """
+    result = repair_table(track.portTable, maxEdits, rewires)
+    if result is None:
+        return None
+    table, edits = result
+
+    names = list(track.junctionNames)
+    k = 0
+    while len(names) < len(table) // 3:
+        k += 1
+        if f'fix{k}' not in names:
+            names.append(f'fix{k}')
+
+    def end(p):
+        j, port = divmod(p, 3)
+        return f'{names[j]}.{PORT_NAMES[port]}'
+
+    oldTable = np.asarray(track.portTable).tolist()
+    config = {}
+    for r in track.runs:
+        p = 3 * track.junctionIds[r.start_junction.name] + PORT_INDEX[r.start_port]
+        if table[p] == oldTable[p]:
+            config[r.name] = [end(p), end(table[p])]
+    used = {p for ends in config.values() for p in ends}
+    i = 0
+    for p, q in enumerate(table):
+        if p < q and end(p) not in used:
+            while f'R{i}' in config:
+                i += 1
+            config[f'R{i}'] = [end(p), end(q)]
+    return config, edits
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Testing candidate "easy rules" for telling good layouts from bad ones.
+
+A rule is any function of a port table that returns True when it thinks
+the layout is good. Rules that work on a whole (count, 3 * n) array of
+tables at once can be marked with @vectorized and get each batch in one
+call, otherwise they are called table by table. Each rule's answers are
+compared with the exact verdict from topology.check_table over a corpus,
+either every layout up to some size (enumerated_corpus) or random samples
+(sampled_corpus). The result is a confusion matrix per rule, plus its
+smallest counterexamples, in canonical form if they have up to
+enumeration.EXACT_JUNCTIONS junctions, ready to give to Track.
+
+    reports = evaluate_rules([root_to_root, no_forced_loop],
+                             enumerated_corpus([2, 4, 6]))
+    for report in reports.values():
+        print(report)
+
+@author: Dan
+"""
+
+from functools import partial
+
+import numpy as np
+
+from enumeration import EXACT_JUNCTIONS, canonical_table, enumerate_tables
+from sampling import random_tables
+from topology import ROOT, table_to_config
+from verify import map_chunks, verify_tables
+
+
+def vectorized(rule):
+    """Mark a rule as taking a (count, 3 * n) array of port tables and
+    returning a bool array of count answers"""
+    rule.vectorized = True
+    return rule
+
+
+@vectorized
+def root_to_root(tables):
+    """The root-to-root hypothesis: a layout is good if some run joins two
+    roots (the README's j1/j2 layout is a counterexample)"""
+    return (tables[:, ROOT::3] % 3 == ROOT).any(axis=1)
+
+
+@vectorized
+def no_forced_loop(tables):
+    """The idea in notes.md: a layout is good unless following runs from
+    root to left/right, root to left/right, ... comes back to the start,
+    a loop where the train never gets to make a decision"""
+    count, nPorts = tables.shape
+    n = nPorts // 3
+    # junction reached by leaving each junction by its root, -1 if it's
+    # entered by its root (a decision, so the chain stops there)
+    reached = tables[:, ROOT::3]
+    follow = np.where(reached % 3 == ROOT, -1, reached // 3)
+    # follow every chain n times, by repeated doubling, anything still
+    # going after that is going round a loop
+    rows = np.arange(count)[:, None]
+    steps = 1
+    while steps < n:
+        follow = np.where(follow < 0, -1, follow[rows, np.maximum(follow, 0)])
+        steps *= 2
+    return (follow < 0).all(axis=1)
+
+
+def enumerated_corpus(sizes):
+    """Every connected layout with each number of junctions in sizes, one
+    (count, 3 * n) array per size"""
+    for n in sizes:
+        tables = list(enumerate_tables(n))
+        if tables:
+            yield np.stack(tables)
+
+
+def sampled_corpus(sizes, count, rng=None, batchsize=100000):
+    """count uniformly random layouts (see sampling.random_tables) for each
+    number of junctions in sizes, in batches of at most batchsize"""
+    rng = np.random.default_rng(rng)
+    for n in sizes:
+        for start in range(0, count, batchsize):
+            yield random_tables(n, min(batchsize, count - start), rng)
+
+
+class RuleReport():
+    # how one rule did against the exact verdicts
+
+    def __init__(self, name, keep=3):
+        self.name = name
+        self.keep = keep
+        # rows: actually good, actually bad, columns: rule says good, bad
+        self.confusion = np.zeros((2, 2), dtype=np.int64)
+        self.falsePositives = []  # bad layouts the rule passes, smallest first
+        self.falseNegatives = []  # good layouts the rule fails, smallest first
+
+    @property
+    def total(self):
+        return int(self.confusion.sum())
+
+    @property
+    def accuracy(self):
+        return np.trace(self.confusion) / max(self.total, 1)
+
+    @property
+    def exact(self):
+        """True if the rule never disagreed with the exact verdict"""
+        return self.confusion[0, 1] == 0 and self.confusion[1, 0] == 0
+
+    def add(self, tables, truth, said):
+        self.confusion += [[np.count_nonzero(truth & said), np.count_nonzero(truth & ~said)],
+                           [np.count_nonzero(~truth & said), np.count_nonzero(~truth & ~said)]]
+        self._collect(self.falsePositives, tables[~truth & said])
+        self._collect(self.falseNegatives, tables[truth & ~said])
+
+    def _collect(self, examples, tables):
+        # keep the smallest few distinct counterexamples, by number of
+        # junctions and then by canonical port table. Bigger layouts take
+        # too long to put in canonical form, the first few found are kept
+        # as they are.
+        size = tables.shape[1]
+        full = len(examples) >= self.keep
+        if not len(tables) or (full and len(examples[-1]) < size):
+            return
+        exact = size <= 3 * EXACT_JUNCTIONS
+        if not exact and full and len(examples[-1]) == size:
+            return
+        seen = {t.tobytes() for t in examples}
+        for t in tables[:self.keep * 10] if exact else tables[:self.keep]:
+            c = canonical_table(t) if exact else np.array(t)
+            if c.tobytes() not in seen:
+                seen.add(c.tobytes())
+                examples.append(c)
+        examples.sort(key=lambda t: (len(t), t.tolist()))
+        del examples[self.keep:]
+
+    def counterexamples(self):
+        """The smallest counterexamples as run configs, (false positives,
+        false negatives)"""
+        return ([table_to_config(t) for t in self.falsePositives],
+                [table_to_config(t) for t in self.falseNegatives])
+
+    def __str__(self):
+        (tp, fn), (fp, tn) = self.confusion.tolist()
+        lines = [f'{self.name}: {self.total} layouts, accuracy {self.accuracy:.4f}',
+                 f'{"":>14}{"says good":>12}{"says bad":>12}',
+                 f'{"actually good":>14}{tp:>12}{fn:>12}',
+                 f'{"actually bad":>14}{fp:>12}{tn:>12}']
+        falsePositives, falseNegatives = self.counterexamples()
+        if falsePositives:
+            lines.append(f'smallest bad layout it passes: {falsePositives[0]}')
+        if falseNegatives:
+            lines.append(f'smallest good layout it fails: {falseNegatives[0]}')
+        return '\n'.join(lines)
+
+
+def _apply_rule(rule, tables):
+    if getattr(rule, 'vectorized', False):
+        return np.asarray(rule(np.stack(tables)), dtype=bool).tolist()
+    return [bool(rule(t)) for t in tables]
+
+
+def evaluate_rules(rules, corpus, workers=1, keep=3, chunksize=10000):
+    """Compare rules with the exact good/bad verdict over a corpus
+
+    Parameters
+    ----------
+    rules : list of functions, or dict of name: function
+        each takes a port table (or a batch of them if @vectorized) and
+        returns True for a layout it thinks is good
+    corpus : iterable of (count, 3 * n) arrays of port tables,
+        see enumerated_corpus and sampled_corpus
+    workers : int or None
+        processes to spread the work over (see verify.verify_tables). Rules
+        have to be picklable, i.e. defined at the top level of a module,
+        to run in another process.
+    keep : int
+        number of counterexamples of each kind to keep per rule
+
+    Returns
+    -------
+    dict of rule name: RuleReport
+    """
+    if not isinstance(rules, dict):
+        rules = {rule.__name__: rule for rule in rules}
+    reports = {name: RuleReport(name, keep) for name in rules}
+    for tables in corpus:
+        tables = np.asarray(tables, dtype=np.int32)
+        truth = np.fromiter(verify_tables(tables, workers, chunksize), dtype=bool, count=len(tables))
+        for name, rule in rules.items():
+            said = np.fromiter(map_chunks(partial(_apply_rule, rule), tables, workers, chunksize),
+                               dtype=bool, count=len(tables))
+            reports[name].add(tables, truth, said)
+    return reports
+
+
+if __name__ == "__main__":
+    for report in evaluate_rules([root_to_root, no_forced_loop], enumerated_corpus([2, 4, 6, 8])).values():
+        print(report)
+        print()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Random layouts, for stress tests and statistics.
+
+A layout with N junctions is a perfect matching of its 3N ports: every
+port is joined to exactly one other by a run. Shuffling the ports and
+pairing them off in order gives every matching with the same probability,
+and numpy can shuffle millions of rows at once, so whole batches of port
+tables are made without a Python loop. Layouts can also be conditioned on
+being good or bad, or on their number of reversing loops, by drawing
+batches and keeping the ones that match.
+
+Everything takes rng, a seed or a numpy Generator, so samples can be
+repeated exactly.
+
+@author: Dan
+"""
+
+import numpy as np
+
+from topology import LEFT, RIGHT
+from verify import verify_tables
+
+# most ports drawn per batch, by default, so a batch takes at most about
+# the same memory whatever the number of junctions
+BATCH_PORTS = 3000000
+
+
+def random_tables(n, count, rng=None):
+    """count uniformly random port tables of layouts with n junctions
+
+    Returns an int32 array of shape (count, 3 * n), one port table per row.
+    n has to be even, with an odd number of junctions there's always a
+    port left over.
+    """
+    if n % 2:
+        raise ValueError(f'Layouts need an even number of junctions, not {n}')
+    rng = np.random.default_rng(rng)
+    ports = rng.permuted(np.broadcast_to(np.arange(3 * n, dtype=np.int32), (count, 3 * n)), axis=1)
+    tables = np.empty((count, 3 * n), dtype=np.int32)
+    np.put_along_axis(tables, ports[:, 0::2], ports[:, 1::2], axis=1)
+    np.put_along_axis(tables, ports[:, 1::2], ports[:, 0::2], axis=1)
+    return tables
+
+
+def count_reversing_loops(tables):
+    """Number of junctions whose left branch runs straight back into their
+    own right branch, for each row of a (count, 3 * n) array of tables"""
+    tables = np.atleast_2d(tables)
+    rights = np.arange(RIGHT, tables.shape[1], 3)
+    return (tables[:, LEFT::3] == rights).sum(axis=1)
+
+
+def sample_tables(n, count, good=None, loops=None, rng=None, batchsize=None, workers=1,
+                  maxBatches=1000):
+    """count random port tables, conditioned on what they look like
+
+    Tables are drawn uniformly (see random_tables) and only the ones that
+    match are kept, so the result is uniform over the layouts that match.
+
+    Parameters
+    ----------
+    good : bool or None
+        keep only good (True) or bad (False) layouts, or either (None).
+        Good layouts get rare quickly as n grows, so asking for them is
+        slow for big n.
+    loops : int, (min, max) or None
+        keep only layouts with this many reversing loops, or a number in
+        this range (inclusive)
+    rng : seed or numpy Generator
+    batchsize : int or None
+        tables drawn at a time. By default the first batch is count tables,
+        and each one after that is twice what the rest would need at the
+        rate tables have matched so far (twice the last one if none have),
+        up to BATCH_PORTS / (3 * n)
+    workers : int or None
+        processes used to check good/bad, see verify.verify_tables
+    maxBatches : int
+        give up with a RuntimeError after drawing this many batches
+
+    Returns
+    -------
+    np.array of int32, shape (count, 3 * n)
+    """
+    rng = np.random.default_rng(rng)
+    largest = max(BATCH_PORTS // (3 * n), 1)
+    size = batchsize or min(count, largest)
+    if isinstance(loops, int):
+        loops = (loops, loops)
+    kept = []
+    nKept = 0
+    nDrawn = 0
+    for batch in range(maxBatches):
+        if nKept >= count:
+            break
+        tables = random_tables(n, size, rng)
+        nDrawn += size
+        if loops is not None:
+            k = count_reversing_loops(tables)
+            tables = tables[(k >= loops[0]) & (k <= loops[1])]
+        if good is not None and len(tables):
+            verdicts = np.fromiter(verify_tables(tables, workers, chunksize=10000), dtype=bool,
+                                   count=len(tables))
+            tables = tables[verdicts == good]
+        kept.append(tables)
+        nKept += len(tables)
+        if batchsize is None:
+            size = -(-2 * (count - nKept) * nDrawn // nKept) if nKept else 2 * size
+            size = min(max(size, 1), largest)
+    if nKept < count:
+        raise RuntimeError(f'Only found {nKept} of {count} matching layouts in '
+                           f'{maxBatches} batches, {nDrawn} tables')
+    return np.concatenate(kept)[:count]
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Several trains running on one layout at once.
+
+Trains move over the port graph (see topology.py) like the single train in
+Track.traverse, and make their choices the same way: at a junction entered
+by its root a train turns left the first time it's there, right the
+second time and picks at random after that. Entered by a branch it has to
+leave by the root, and the switch is set to the branch it came from. Each
+train keeps its own decision log, so it also notices, like traverse does,
+when it has gone round a loop without making any new decisions (trapped).
+
+Trains are points. Each is always in exactly one run or one junction and
+moves on by events from a priority queue: arriving at the end of a run
+and leaving a junction. A run takes its length / the train's speed to
+travel along and a junction takes junctionTime.
+
+With signals (the default) every run and every junction is a block that
+only one train can be in. A train that wants to move into an occupied
+block waits where it is, first come first served, still holding the block
+it's in. That can deadlock, when a ring of trains each wait for the next,
+and can starve a train that waits longer than maxWait. Without signals
+trains never wait, and trains meeting head on or catching each other up
+on a run, or in the same junction at once, are recorded as collisions.
+
+@author: Dan
+"""
+
+import heapq
+import random
+from collections import deque
+
+import numpy as np
+
+from topology import ROOT, LEFT, RIGHT, PORT_NAMES
+
+ARRIVE, LEAVE = 0, 1  # events: reaching the end of a run, leaving a junction
+
+
+class SimulationReport():
+    # what happened in a simulation, see Simulation.run
+
+    def __init__(self, time, events, collisions, deadlocks, starved, trains):
+        self.time = time
+        self.events = events
+        self.collisions = collisions  # (time, kind, where, trains)
+        self.deadlocks = deadlocks  # (time, trains waiting on each other)
+        self.starved = starved  # (train, when it started waiting, how long)
+        self.trains = trains  # one dict of statistics per train
+
+    def __str__(self):
+        trapped = sum(t['trapped'] is not None for t in self.trains)
+        return (f'{len(self.trains)} trains, {self.time:g} time units, {self.events} events: '
+                f'{len(self.collisions)} collisions, {len(self.deadlocks)} deadlocks, '
+                f'{len(self.starved)} starved, {trapped} trapped')
+
+
+class Simulation():
+    # discrete event simulation of trains on a layout given by its port table
+
+    def __init__(self, table, nTrains, lengths=None, speeds=1.0, junctionTime=0.1, signals=True,
+                 maxWait=None, seed=None, junctionNames=None):
+        """
+        Parameters
+        ----------
+        table : port table
+        nTrains : int
+        lengths : sequence of float or None
+            length of the run leaving each port, all 1 by default
+        speeds : float or sequence of nTrains floats
+        junctionTime : float
+            time it takes to pass through a junction
+        signals : bool
+            whether trains wait for blocks to be clear, see the module docstring
+        maxWait : float or None
+            a train waiting longer than this is starved, by default ten
+            times the longest time to travel a run and a junction
+        seed : int or None
+            for the starting positions and random decisions
+        junctionNames : list of str, used to describe places in the report
+        """
+        self.table = np.asarray(table).tolist()
+        if -1 in self.table:
+            raise ValueError('Every port needs to be connected to simulate a layout')
+        nPorts = len(self.table)
+        self.nJunctions = nPorts // 3
+        self.junctionNames = junctionNames or [f'j{i + 1}' for i in range(self.nJunctions)]
+        self.lengths = [1.0] * nPorts if lengths is None else [float(x) for x in lengths]
+        self.speeds = [float(s) for s in np.broadcast_to(speeds, (nTrains,))]
+        self.junctionTime = junctionTime
+        self.signals = signals
+        if maxWait is None:
+            maxWait = 10 * (max(self.lengths) / min(self.speeds) + junctionTime)
+        self.maxWait = maxWait
+        self.random = random.Random(seed)
+
+        # blocks: junction j is block j, the run between ports p and q is
+        # block nJunctions + min(p, q)
+        nBlocks = self.nJunctions + nPorts
+        self.occupants = [[] for b in range(nBlocks)]
+        self.queues = [deque() for b in range(nBlocks)]
+        self.switches = [LEFT] * self.nJunctions
+
+        self.time = 0.0
+        self.events = 0
+        self.queue = []
+        self.sequence = 0  # ties in the queue go first come first served
+        self.collisions = []
+        self.deadlocks = []
+        self.starved = []
+
+        # per train
+        self.port = [0] * nTrains  # port it's heading for
+        self.block = [None] * nTrains  # block it's in
+        self.due = [0.0] * nTrains  # when it gets to port
+        self.waitingFor = [None] * nTrains
+        self.waitingSince = [0.0] * nTrains
+        self.deadlocked = [False] * nTrains
+        self.decisionLog = [[0] * self.nJunctions for k in range(nTrains)]
+        self.dCountLog = [[-1] * self.nJunctions for k in range(nTrains)]
+        self.decisions = [0] * nTrains
+        self.hops = [0] * nTrains
+        self.distance = [0.0] * nTrains
+        self.waited = [0.0] * nTrains
+        self.trapped = [None] * nTrains
+        self.covered = [set() for k in range(nTrains)]
+
+        # start the trains on different runs where possible, somewhere
+        # along them, heading either way
+        runStarts = [p for p, q in enumerate(self.table) if p < q]
+        if signals and nTrains > len(runStarts):
+            raise ValueError(f'Only {len(runStarts)} runs for {nTrains} trains')
+        if nTrains <= len(runStarts):
+            starts = self.random.sample(runStarts, nTrains)
+        else:
+            starts = [self.random.choice(runStarts) for k in range(nTrains)]
+        for k, p in enumerate(starts):
+            if self.random.random() < 0.5:
+                p = self.table[p]
+            q = self.table[p]
+            block = self._runBlock(p)
+            self.occupants[block].append(k)
+            self.block[k] = block
+            self.port[k] = q
+            self._schedule(self.random.random() * self.lengths[p] / self.speeds[k], ARRIVE, k)
+
+    def run(self, until):
+        """Run the simulation up to time until (it can be carried on with
+        another call) and return a SimulationReport"""
+        queue = self.queue
+        while queue and queue[0][0] <= until:
+            self.time, seq, kind, k = heapq.heappop(queue)
+            self.events += 1
+            if kind == ARRIVE:
+                self._arrive(k)
+            else:
+                self._leave(k)
+        if not queue:
+            # everything that could move has stopped
+            until = self.time
+        self.time = until
+        return self.report()
+
+    def report(self):
+        starved = list(self.starved)
+        for k, block in enumerate(self.waitingFor):
+            if block is not None and not self.deadlocked[k] and self.time - self.waitingSince[k] > self.maxWait:
+                starved.append((k, self.waitingSince[k], self.time - self.waitingSince[k]))
+        nDirections = len(self.table)
+        trains = [{'hops': self.hops[k],
+                   'decisions': self.decisions[k],
+                   'distance': self.distance[k],
+                   'waited': self.waited[k],
+                   'trapped': self.trapped[k],
+                   'coverage': len(self.covered[k]) / nDirections,
+                   'at': self.describe(self.block[k])}
+                  for k in range(len(self.port))]
+        return SimulationReport(self.time, self.events, list(self.collisions), list(self.deadlocks),
+                                starved, trains)
+
+    def describe(self, block):
+        """Readable name of a block, 'j1' or 'j1.left-j2.root'"""
+        if block < self.nJunctions:
+            return self.junctionNames[block]
+        p = block - self.nJunctions
+        return f'{self._portName(p)}-{self._portName(self.table[p])}'
+
+    def _portName(self, p):
+        j, port = divmod(p, 3)
+        return f'{self.junctionNames[j]}.{PORT_NAMES[port]}'
+
+    def _runBlock(self, p):
+        return self.nJunctions + min(p, self.table[p])
+
+    def _schedule(self, delay, kind, k):
+        self.sequence += 1
+        heapq.heappush(self.queue, (self.time + delay, self.sequence, kind, k))
+
+    def _arrive(self, k):
+        # at the end of a run, heading into a junction
+        j = self.port[k] // 3
+        if self._acquire(k, j, ARRIVE):
+            self._enterJunction(k)
+
+    def _leave(self, k):
+        # at a port of a junction, heading out along its run
+        if self._acquire(k, self._runBlock(self.port[k]), LEAVE):
+            self._enterRun(k)
+
+    def _enterJunction(self, k):
+        p = self.port[k]
+        j, port = divmod(p, 3)
+        log = self.decisionLog[k]
+        if port == ROOT:
+            # same choices as Track.traverse
+            if log[j] == 0:
+                branch = LEFT
+            elif log[j] == 1:
+                branch = RIGHT
+            else:
+                branch = self.random.choice((LEFT, RIGHT))
+            log[j] += 1
+            self.decisions[k] += 1
+            exit = 3 * j + branch
+        else:
+            branch = port
+            if self.dCountLog[k][j] == self.decisions[k] and self.trapped[k] is None:
+                # back here without making a decision since last time
+                self.trapped[k] = self.time
+            self.dCountLog[k][j] = self.decisions[k]
+            exit = 3 * j + ROOT
+        self.switches[j] = branch
+        self.port[k] = exit
+        self.due[k] = self.time + self.junctionTime
+        self._schedule(self.junctionTime, LEAVE, k)
+
+    def _enterRun(self, k):
+        p = self.port[k]
+        q = self.table[p]
+        travel = self.lengths[p] / self.speeds[k]
+        self.hops[k] += 1
+        self.distance[k] += self.lengths[p]
+        self.covered[k].add(p)
+        self.port[k] = q
+        self.due[k] = self.time + travel
+        self._schedule(travel, ARRIVE, k)
+
+    def _acquire(self, k, block, kind):
+        """Move train k into block if it can, returns False if it has to wait"""
+        occupants = self.occupants[block]
+        if occupants == [k]:
+            pass  # handed over by the train that just left, see _release
+        elif self.signals and occupants:
+            self.queues[block].append((k, kind))
+            self.waitingFor[k] = block
+            self.waitingSince[k] = self.time
+            self._checkDeadlock(k)
+            return False
+        else:
+            if occupants:
+                self._checkCollision(k, block)
+            occupants.append(k)
+        self._release(k, self.block[k])
+        self.block[k] = block
+        return True
+
+    def _release(self, k, block):
+        occupants = self.occupants[block]
+        occupants.remove(k)
+        queue = self.queues[block]
+        if queue and not occupants:
+            # hand the block straight to the first train waiting for it,
+            # which carries on with what it was trying to do
+            waiter, kind = queue.popleft()
+            occupants.append(waiter)
+            waited = self.time - self.waitingSince[waiter]
+            self.waited[waiter] += waited
+            if waited > self.maxWait:
+                self.starved.append((waiter, self.waitingSince[waiter], waited))
+            self.waitingFor[waiter] = None
+            self._schedule(0.0, kind, waiter)
+
+    def _checkDeadlock(self, k):
+        # follow who's waiting for whom, each train waits for at most one
+        # block and each block holds at most one train
+        ring = [k]
+        block = self.waitingFor[k]
+        for step in range(len(self.port)):
+            holder = self.occupants[block][0]
+            if holder == k:
+                for t in ring:
+                    self.deadlocked[t] = True
+                self.deadlocks.append((self.time, ring))
+                return
+            block = self.waitingFor[holder]
+            if block is None:
+                return
+            ring.append(holder)
+
+    def _checkCollision(self, k, block):
+        if block < self.nJunctions:
+            self.collisions.append((self.time, 'junction', self.describe(block), [k] + self.occupants[block]))
+            return
+        q = self.table[self.port[k]]  # where k is heading along the run
+        arrival = self.time + self.lengths[self.port[k]] / self.speeds[k]
+        for other in self.occupants[block]:
+            if self.port[other] != q:
+                self.collisions.append((self.time, 'head on', self.describe(block), [k, other]))
+            elif arrival < self.due[other]:
+                self.collisions.append((self.time, 'rear end', self.describe(block), [k, other]))
+
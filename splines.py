@@ -6,103 +6,428 @@ Created on Wed Jun 18 19:51:16 2025
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 import random
 
+from geometry import JunctionStore, PortArrays, TrackGeometry, bezier_cubic, bezier_curvature, bezier_lengths
+from instrument import COVERED, FAILED, LOOP, NO_LOOP, STUCK
+from topology import ROOT, LEFT, RIGHT, PORT_NAMES, build_port_table, check_table, describe_states, parse_end
+
+# the modules behind the background analysis, clearances, optimizing,
+# rendering, repair, simulation, tours and the verdict cache are imported by
+# the methods that use them, so a Track only used for its topology doesn't
+# load them all
+
 
 def rotation_matrix(theta):
     """Returns a 2D rotation matrix for angle theta (in degrees)."""
+    theta = np.deg2rad(theta)
+    c, s = np.cos(theta), np.sin(theta)
     return np.array([
-        [np.cos(np.deg2rad(theta)), -np.sin(np.deg2rad(theta))],
-        [np.sin(np.deg2rad(theta)), np.cos(np.deg2rad(theta))]
+        [c, -s],
+        [s, c]
     ])
 
 
-def bezier_cubic(P0, P1, P2, P3, n=100):
-    t = np.linspace(0, 1, n)[:, None]  # shape (100, 1)
-
-    return (1 - t)**3 * P0 + \
-        3 * (1 - t)**2 * t * P1 + \
-        3 * (1 - t) * t**2 * P2 + \
-        t**3 * P3
-
-
 class Track():
     # a track contains some junctions and connections
 
-    def __init__(self, config):
+    def __init__(self, config, headless=False, seed=None):
         # from the config, connect all the junctions
         # config has the form of a dictionary with entries
         # {"name of run": ["<junction name>.<left|right|root>",
         #                  "<junction name>.<left|right|root>"]}
-
-        self.junctions = {}  # keys = names, values = junction objects
-        self.runs = []
+        #
+        # with headless=True only the port table is built, which is all
+        # traverse, findLoops and checkLayout need. The junctions, runs and
+        # their geometry are made the first time something asks for them.
+        #
+        # seed fixes the random junction placement and the random choices
+        # made by traverse, by default the global np.random and random
+        # states are used.
+
+        self.config = config
         self.runScale = 0.5
-
-        for k, v in config.items():  # for each run
-            for end in v:  # for each connection termination
-                currentJunctionName = end.split('.')[0]
-                if currentJunctionName not in self.junctions.keys():
-                    self.junctions[currentJunctionName] = Junction(np.random.randn(2) * 2,
-                                                                   np.random.rand() * 360,
-                                                                   currentJunctionName)
-                else:
-                    pass
-            # now that all the junctions associated with the current run have been created,
+        if seed is None:
+            self.rng = np.random
+            self.random = random
+        else:
+            self.rng = np.random.default_rng(seed)
+            self.random = random.Random(seed)
+
+        # integer port table used by all the traversal / analysis routines,
+        # junction id i is self.junctionNames[i], port 3 * i + ROOT|LEFT|RIGHT
+        self.junctionNames, self.portTable = build_port_table(config)
+        self.junctionIds = {name: i for i, name in enumerate(self.junctionNames)}
+
+        self._junctions = None  # made by buildGeometry
+        self.clearanceIndex = None  # made by checkClearance
+        self.analysisWorker = None  # made by startAnalysis
+        self.analysis = {}  # latest result of each kind of background analysis
+        self.analysisMoved = set()  # names of junctions moved since the last analysis, None for all
+        self.analysisDue = False  # edits waiting for the running analysis to finish
+        self._energy = None
+        self._canonicalKey = None
+        if not headless:
+            self.buildGeometry()
+
+    def buildGeometry(self, store=None):
+        """Make the Junction and Run objects and the geometry behind them,
+        done straight away unless the Track is headless. store is a
+        geometry.JunctionStore of the junctions in id order, by default
+        they're placed at random."""
+        junctions = {}  # keys = names, values = junction objects
+        runs = []
+
+        # all the junction geometry lives in one store, the Junction
+        # objects are views onto it
+        if store is None:
+            store = JunctionStore.random(len(self.junctionNames), self.rng)
+        for i, name in enumerate(self.junctionNames):
+            junctions[name] = Junction(None, None, name, store=store, index=i)
+
+        for k, v in self.config.items():  # for each run
             # make a run object from the current run
             startJunctionName = v[0].split('.')[0]
             startJunctionNode = v[0].split('.')[1]
             endJunctionName = v[1].split('.')[0]
             endJunctionNode = v[1].split('.')[1]
-            self.runs.append(Run(
-                start_junction=self.junctions[startJunctionName],
+            runs.append(Run(
+                start_junction=junctions[startJunctionName],
                 start_port=startJunctionNode,
-                end_junction=self.junctions[endJunctionName],
+                end_junction=junctions[endJunctionName],
                 end_port=endJunctionNode,
                 name=k,
                 scale=self.runScale
             ))
 
-    def draw(self):
+        # which runs touch each junction, so moving a junction only
+        # has to recalculate its own runs
+        junctionRuns = {name: [] for name in self.junctionNames}
+        for r in runs:
+            junctionRuns[r.start_junction.name].append(r)
+            if r.end_junction is not r.start_junction:
+                junctionRuns[r.end_junction.name].append(r)
+
+        self._junctions = junctions
+        self._runs = runs
+        self._junctionRuns = junctionRuns
+        self._store = store
+        # all the curves of the layout, calculated together
+        self._geometry = TrackGeometry(self)
+
+    @property
+    def junctions(self):
+        if self._junctions is None:
+            self.buildGeometry()
+        return self._junctions
+
+    @property
+    def runs(self):
+        if self._junctions is None:
+            self.buildGeometry()
+        return self._runs
+
+    @property
+    def junctionRuns(self):
+        if self._junctions is None:
+            self.buildGeometry()
+        return self._junctionRuns
+
+    @property
+    def store(self):
+        if self._junctions is None:
+            self.buildGeometry()
+        return self._store
+
+    @property
+    def geometry(self):
+        if self._junctions is None:
+            self.buildGeometry()
+        return self._geometry
+
+    def calculateCurves(self):
+        """Recalculate the curves of every run and junction in one batch"""
+        if self.geometry.tolerance is not None and hasattr(self, 'ax'):
+            # adaptive sampling tolerance is in pixels once drawn
+            x0, x1 = self.ax.transData.transform([[0, 0], [1, 0]])[:, 0]
+            self.geometry.viewScale = max(abs(x1 - x0), 1e-9)
+        self.geometry.calculateCurves()
+
+    def setSampling(self, tolerance=None, n=100):
+        """Sample every curve with n points (tolerance=None), or with only
+        as many as it needs to stay within tolerance of the true curve, in
+        pixels once the track is drawn and layout units before that.
+        n is then the most points any curve gets."""
+        self.geometry.tolerance = tolerance
+        self.geometry.n = n
+        self.calculateCurves()
+        self.redraw()
+
+    def runLengths(self):
+        """{run name: arc length}, worked out from the control points"""
+        return dict(zip((r.name for r in self.runs), self.geometry.runLengths().tolist()))
+
+    def draw(self, analyse=False):
+        # with analyse, the layout is checked in the background as it's
+        # edited and the runs are coloured to match, see startAnalysis.
+        # It's off by default, it costs a lot on big layouts.
+        import matplotlib.pyplot as plt  # only needed once there is something to draw
         fig, ax = plt.subplots()
         self.fig = fig
         self.ax = ax
         self.dragged_junction = None
         self.angled_junction = None
+        self.blitArtists = []
+        self.background = None
+        self.calculateCurves()
         for j in self.junctions.values():
-            j.draw(ax)
+            j.draw(ax, recalculate=False)
 
         for r in self.runs:
-            r.draw(ax)
+            r.draw(ax, recalculate=False)
 
         fig.canvas.mpl_connect('button_press_event', self.on_press)
         fig.canvas.mpl_connect('motion_notify_event', self.on_motion)
         fig.canvas.mpl_connect('button_release_event', self.on_release)
         fig.canvas.mpl_connect('scroll_event', self.on_scroll)
+        fig.canvas.mpl_connect('close_event', self.on_close)
 
         ax.set_title('Blue circles = move, Black circles=rotate \n Pink Squares=flip junction, scroll=tighten/loosen curves')
 
         ax.axis('equal')
+        if analyse:
+            self.startAnalysis()
         fig.show()
 
     def redraw(self):
         if not hasattr(self, 'ax'):
             return  # Cannot redraw before draw() is called
 
-        self.ax.clear()  # Clear previous visuals
+        # Update all junctions and connections in place, the artists
+        # made by draw() are kept and just get new data
+        self.calculateCurves()
+        for j in self.junctions.values():
+            j.update_artists()
 
-        self.ax.set_title('Blue circles = move, Black circles=rotate \n Pink Squares=flip junction, scroll=tighten/loosen curves')
+        for r in self.runs:
+            r.update_artist()
 
-        # Redraw all junctions and connections
-        for j in self.junctions.values():
-            j.draw(self.ax)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.fig.canvas.draw_idle()
 
+    def copy(self):
+        """A Track with the same runs and its own copy of this one's
+        geometry, to change without changing this one"""
+        store = self.store
+        copied = JunctionStore(store.n)
+        copied.loc[:] = store.loc
+        copied.direction[:] = store.direction
+        copied.swapped[:] = store.swapped
+        copied.scale[:] = store.scale
+        copied.update()
+        track = Track(self.config, headless=True)
+        track.runScale = self.runScale
+        track.buildGeometry(copied)
+        return track
+
+    def render(self, path, **kwargs):
+        """Save a picture of the layout to path, .png or .svg, without
+        opening a window, see render.render_sheet for the options"""
+        from render import render_sheet
+        return render_sheet([self], path, **kwargs)
+
+    def optimize(self, **kwargs):
+        """Rearrange the junctions to minimise the energy of the runs,
+        see optimize.optimize_layout for the options"""
+        from optimize import optimize_layout
+        energy = optimize_layout(self, **kwargs)
+        self.redraw()
+        self.analyse()
+        return energy
+
+    def quantize(self, **kwargs):
+        """Every run as a chain of fixed track pieces, with how far each
+        misses its end port and strays from its curve, see
+        pieces.quantize_track for the options"""
+        from pieces import quantize_track
+        return quantize_track(self, **kwargs)
+
+    def checkClearance(self, clearance=0.3):
+        """Index the runs for crossings and near misses, see
+        clearance.ClearanceIndex. The index is kept up to date as
+        junctions are moved in the editor."""
+        from clearance import ClearanceIndex
+        self.clearanceIndex = ClearanceIndex(self, clearance)
+        return self.clearanceIndex
+
+    def startAnalysis(self, clearance=0.3, interval=100):
+        """Work out whether the layout is good, which runs cross or come
+        closer than clearance, and the energy of the runs, on a background
+        thread (see analysis.py), again every time the layout is edited.
+        Once drawn, the results are picked up every interval milliseconds
+        and shown by colouring the runs. Without a drawing, call
+        collectAnalysis to pick them up."""
+        from analysis import AnalysisWorker
+        from clearance import ClearanceIndex
+        if self.analysisWorker is None:
+            self.analysisWorker = AnalysisWorker()
+        self.analysisClearance = clearance
+        self._energy = None
+        if self.clearanceIndex is None or self.clearanceIndex.clearance != clearance:
+            # built by the first analysis, in the background
+            self.clearanceIndex = ClearanceIndex(self, clearance, build=False)
+            self.analysisMoved = None
+        self.analyse(topology=True, moved=[])
+        if hasattr(self, 'fig') and not hasattr(self, 'analysisTimer'):
+            self.analysisTimer = self.fig.canvas.new_timer(interval=interval)
+            self.analysisTimer.add_callback(self.collectAnalysis)
+            self.analysisTimer.start()
+
+    def stopAnalysis(self):
+        if hasattr(self, 'analysisTimer'):
+            self.analysisTimer.stop()
+            del self.analysisTimer
+        if self.analysisWorker is not None:
+            self.analysisWorker.close()
+            self.analysisWorker = None
+            # a job may still be updating the index, and it's missing any
+            # edits that were waiting, so it's left behind
+            self.clearanceIndex = None
+        self.analysisMoved = set()
+        self.analysisDue = False
+
+    def analyse(self, topology=False, moved=None):
+        """Send the layout as it is now to the background analysis, if it
+        has been started. moved lists the junctions that have moved since
+        the last call, None if anything might have changed (the runs were
+        rescaled, say), only their runs are measured for clearance again.
+        While the last clearance and energy jobs are still running nothing
+        is sent, the edits wait for collectAnalysis to send them all in one
+        go. The port table only changes when the track is rebuilt, so the
+        good/bad check is only done again if topology is set."""
+        from analysis import CROSSINGS, ENERGY, TOPOLOGY, layout_energy, trap_runs, update_clearances
+        from optimize import LayoutEnergy
+        worker = self.analysisWorker
+        if worker is None:
+            return
+        if moved is None:
+            self.analysisMoved = None
+        elif self.analysisMoved is not None:
+            self.analysisMoved.update(j.name for j in moved)
+        geometry = self.geometry
+        if topology:
+            worker.submit(TOPOLOGY, trap_runs, self.portTable, geometry.runPorts)
+        if worker.running(CROSSINGS) or worker.running(ENERGY):
+            self.analysisDue = True
+            return
+        self.analysisDue = False
+        if not all(hasattr(r, 'curve') for r in self.runs):
+            self.calculateCurves()
+        # the index belongs to the worker while analysis is running, the
+        # curve arrays it reads are replaced, never changed in place, when
+        # the layout moves
+        if self.analysisMoved is None:
+            runs = None
+        else:
+            runs = list({id(r): r for name in self.analysisMoved for r in self.junctionRuns[name]}.values())
+        self.analysisMoved = set()
+        worker.submit(CROSSINGS, update_clearances, self.clearanceIndex, runs)
+        if self._energy is None:
+            self._energy = LayoutEnergy(self, clearance=self.analysisClearance)
+        store = self.store
+        worker.submit(ENERGY, layout_energy, self._energy, store.loc.copy(), np.deg2rad(store.direction),
+                      store.swapped.copy())
+
+    def collectAnalysis(self):
+        """Pick up any finished background analysis into self.analysis,
+        and show it if the track is drawn, then send any edits that were
+        waiting for it. Returns the new results."""
+        if self.analysisWorker is None:
+            return {}
+        results = self.analysisWorker.results()
+        if results:
+            self.analysis.update(results)
+            self.showAnalysis()
+        if self.analysisDue:
+            self.analyse(moved=[])
+        return results
+
+    def showAnalysis(self):
+        """Colour the runs by the latest analysis results, see analysis.py"""
+        from analysis import CLOSE_COLOR, CROSSING_COLOR, CROSSINGS, ENERGY, RUN_COLOR, TOPOLOGY, TRAP_COLOR
+        colors = [RUN_COLOR] * len(self.runs)
+        status = []
+        if TOPOLOGY in self.analysis:
+            good, trapped = self.analysis[TOPOLOGY]
+            for i in np.nonzero(trapped)[0].tolist():
+                colors[i] = TRAP_COLOR
+            status.append('good layout' if good else f'bad layout, {int(trapped.sum())} runs in a trap')
+        if CROSSINGS in self.analysis:
+            pairs = self.analysis[CROSSINGS]
+            for (i, j), d in pairs.items():
+                for k in (i, j):
+                    if d == 0:
+                        colors[k] = CROSSING_COLOR
+                    elif colors[k] != CROSSING_COLOR:
+                        colors[k] = CLOSE_COLOR
+            crossings = sum(d == 0 for d in pairs.values())
+            status.append(f'{crossings} crossings, {len(pairs) - crossings} too close')
+        if ENERGY in self.analysis:
+            status.append(f'energy {self.analysis[ENERGY][0]:.4g}')
+        for r, color in zip(self.runs, colors):
+            r.color = color
+
+        if not hasattr(self, 'ax'):
+            return
         for r in self.runs:
-            r.calculateCurve()
-            r.draw(self.ax)
+            r.update_artist()
+        self.ax.set_xlabel(', '.join(status))
+        if self.background is not None:
+            # mid drag only the dragged runs are redrawn, the rest catch
+            # up when it's let go
+            self.blit()
+        else:
+            self.fig.canvas.draw_idle()
 
-        self.ax.axis('equal')
+    def update_junction(self, junction):
+        """Recalculate and update the artists of one junction and its runs only"""
+        self.geometry.calculateCurves(junction)
+        junction.update_artists()
+        for r in self.junctionRuns[junction.name]:
+            r.update_artist()
+        if self.clearanceIndex is not None and self.analysisWorker is None:
+            # otherwise the background analysis updates it, see analyse
+            self.clearanceIndex.update(junction)
+
+    def start_blit(self, junction):
+        """Grab the background without this junction and its runs, so
+        while it's being dragged only they need drawing"""
+        if not self.fig.canvas.supports_blit:
+            return
+        self.blitArtists = junction.artists() + [r.artist for r in self.junctionRuns[junction.name]]
+        for a in self.blitArtists:
+            a.set_animated(True)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.blit()
+
+    def blit(self):
+        if self.background is None:
+            self.fig.canvas.draw_idle()
+            return
+        self.fig.canvas.restore_region(self.background)
+        for a in self.blitArtists:
+            self.ax.draw_artist(a)
+        self.fig.canvas.blit(self.ax.bbox)
+
+    def stop_blit(self):
+        for a in self.blitArtists:
+            a.set_animated(False)
+        self.blitArtists = []
+        self.background = None
+        self.ax.relim()
+        self.ax.autoscale_view()
         self.fig.canvas.draw_idle()
 
     def on_press(self, event):
@@ -113,6 +438,7 @@ class Track():
             if j.nub_artist.contains(event)[0]:
                 self.dragged_junction = j
                 self.offset = j.loc - np.array([event.xdata, event.ydata])
+                self.start_blit(j)
                 return
 
             # Check for rotation nub
@@ -122,11 +448,13 @@ class Track():
                 vec = np.array([event.xdata, event.ydata]) - self.center
                 self.initial_angle = np.arctan2(vec[1], vec[0])
                 self.initial_direction = j.direction
+                self.start_blit(j)
                 return
 
             elif j.swap_artist.contains(event)[0]:
                 j.swap()
-                self.redraw()
+                self.update_junction(j)
+                self.analyse(moved=[j])
                 self.fig.canvas.draw_idle()
 
     def on_motion(self, event):
@@ -137,8 +465,9 @@ class Track():
             # Handle dragging movement
             new_pos = np.array([event.xdata, event.ydata]) + self.offset
             self.dragged_junction.update_position(new_pos)
-            self.redraw()
-            self.fig.canvas.draw_idle()
+            self.update_junction(self.dragged_junction)
+            self.analyse(moved=[self.dragged_junction])
+            self.blit()
 
         elif self.angled_junction:
             # Handle rotation
@@ -146,10 +475,13 @@ class Track():
             current_angle = np.arctan2(vec[1], vec[0])
             delta_angle = np.rad2deg(self.initial_angle - current_angle)
             self.angled_junction.update_rotation(self.initial_direction + delta_angle)
-            self.redraw()
-            self.fig.canvas.draw_idle()
+            self.update_junction(self.angled_junction)
+            self.analyse(moved=[self.angled_junction])
+            self.blit()
 
     def on_release(self, event):
+        if self.dragged_junction or self.angled_junction:
+            self.stop_blit()
         self.dragged_junction = None
         self.angled_junction = None
 
@@ -161,14 +493,18 @@ class Track():
             self.runScale *= 1 - scale_step
         self.rescale(self.runScale)
         self.redraw()
-        self.fig.canvas.draw_idle()
+        self.analyse()
+
+    def on_close(self, event):
+        self.stopAnalysis()
 
     def rescale(self, scale):
         self.runScale = scale
         for r in self.runs:
-            r.rescale(scale, self.ax)
+            r.rescale(scale)
+        self._energy = None  # made again with the new run scales
 
-    def traverse(self, log=False):
+    def traverse(self, log=False, probe=None):
         """Traverse the track to see if we get stuck in a loop
 
         There are always two phases to each iteration:
@@ -184,93 +520,101 @@ class Track():
         Returns True if we don't get stuck
         Returns False if we get stuck
 
+        probe, an instrument.Probe, gets the number of hops, decisions
+        (and how many of them were random) and why the traversal stopped.
+
         """
+        if probe is not None:
+            started = probe.start()
+        trace = probe is not None and probe.trace
+        hops = 0
+        randomDecisions = 0
         stuck = False
         decisionCount = 0
-        decisionLog = {}  # storage for whether to go left or right at a junction
-        dCountLog = {}  # storage for decision count while entering
+        names = self.junctionNames
+        table = self.portTable.tolist()  # plain list, indexing is cheaper than numpy scalars
+        nJunctions = len(names)
+        decisionLog = [0] * nJunctions  # storage for whether to go left or right at a junction
+        dCountLog = [-1] * nJunctions  # storage for decision count while entering
+        nDecided = 0  # number of junctions where we have turned both left and right
         keepLooking = True
 
         # 10 Start at the root of a random junction in the Track
-        currentJunctionName = random.choice(list(self.junctions.keys()))
-        currentNode = 'root'
+        currentJunction = self.random.randrange(nJunctions)
+        currentNode = ROOT
 
         while keepLooking:
             if log:
-                print(f'Current position: {currentJunctionName}.{currentNode}')
+                print(f'Current position: {names[currentJunction]}.{PORT_NAMES[currentNode]}')
             # phase 1, go from one end of a junction to another
-            if currentNode == 'root':
+            if currentNode == ROOT:
 
                 # if we have turned left and right at all the junctions, then we are done
-                if set(decisionLog.keys()) == set(T.junctions):
-                    if np.all([v >= 2 for v in decisionLog.values()]):
-                        keepLooking = False
-                        continue
+                if nDecided == nJunctions:
+                    keepLooking = False
+                    continue
 
                 # determine whether to go left or right from the decision log
                 # if we have not travelled to this junction yet, go left (0)
-                decisionValue = decisionLog.get(currentJunctionName, 0)
+                decisionValue = decisionLog[currentJunction]
                 if decisionValue == 0:
                     if log:
-                        print(f"I haven't been at {currentJunctionName} before, going left")
-                    currentNode = 'left'  # travel to the left outlet
-                    decisionCount += 1
-                    decisionLog[currentJunctionName] = 1
+                        print(f"I haven't been at {names[currentJunction]} before, going left")
+                    currentNode = LEFT  # travel to the left outlet
                 elif decisionValue == 1:
                     if log:
-                        print(f"I've turned left at {currentJunctionName} before, going right")
-                    currentNode = 'right'  # travel to the right outlet
-                    decisionCount += 1
-                    decisionLog[currentJunctionName] = 2
+                        print(f"I've turned left at {names[currentJunction]} before, going right")
+                    currentNode = RIGHT  # travel to the right outlet
+                    nDecided += 1
                 else:
-                    currentNode = random.choice(['left', 'right'])
+                    currentNode = self.random.choice([LEFT, RIGHT])
+                    randomDecisions += 1
                     if log:
-                        print(f"I've been to {currentJunctionName} twice before, picking {currentNode} randomly")
-                    decisionCount += 1
-                    decisionLog[currentJunctionName] += 1
-            else:  # currentNode is 'left' or 'right', i.e. we have no choice
-                if currentJunctionName in dCountLog.keys():
-                    if decisionCount == dCountLog[currentJunctionName]:
-                        # we haven't made any other decisions since we were last here
-                        if log:
-                            print('we got stuck')
-                        stuck = True
-                        keepLooking = False
-                        continue
-                    else:
-                        # store the current decision count in the dCountLog
-                        dCountLog[currentJunctionName] = decisionCount
-                else:
-                    dCountLog[currentJunctionName] = decisionCount
+                        print(f"I've been to {names[currentJunction]} twice before, "
+                              f"picking {PORT_NAMES[currentNode]} randomly")
+                decisionCount += 1
+                decisionLog[currentJunction] += 1
+                if trace:
+                    probe.decision(currentJunction, currentNode)
+            else:  # currentNode is LEFT or RIGHT, i.e. we have no choice
+                if dCountLog[currentJunction] == decisionCount:
+                    # we haven't made any other decisions since we were last here
+                    if log:
+                        print('we got stuck')
+                    stuck = True
+                    keepLooking = False
+                    continue
+                # store the current decision count in the dCountLog
+                dCountLog[currentJunction] = decisionCount
 
                 # so we exit at the root of this junction
-                currentNode = 'root'
+                currentNode = ROOT
 
             # phase 2 travel to the next junction
-            # find our starting point in the runs structure
+            # look up where the run leaving our current port ends up
             if log:
-                print(f'Current position: {currentJunctionName}.{currentNode}')
-                print(f'Decision Log: {decisionLog}')
-            for r in self.runs:
-                if r.start_junction.name == currentJunctionName and r.start_port == currentNode:
-                    # travel to the end
-                    currentJunctionName = r.end_junction.name
-                    currentNode = r.end_port
-                    break
-                elif r.end_junction.name == currentJunctionName and r.end_port == currentNode:
-                    # travel to the start
-                    currentJunctionName = r.start_junction.name
-                    currentNode = r.start_port
-                    break
-            else:
+                print(f'Current position: {names[currentJunction]}.{PORT_NAMES[currentNode]}')
+                print(f'Decision Log: {dict(zip(names, decisionLog))}')
+            nextPort = table[3 * currentJunction + currentNode]
+            if nextPort < 0:
+                if probe is not None:
+                    probe.finish('traverse', started, FAILED, hops=hops,
+                                 decisions=decisionCount, randomDecisions=randomDecisions)
                 raise ValueError('Could not find a node to travel to next')
-
+            hops += 1
+            if trace:
+                probe.hop(3 * currentJunction + currentNode, nextPort)
+            currentJunction, currentNode = divmod(nextPort, 3)
+
+        if probe is not None:
+            probe.finish('traverse', started, STUCK if stuck else COVERED, hops=hops,
+                         decisions=decisionCount, randomDecisions=randomDecisions)
         if stuck:
             return False
         else:
             return True
 
-    def findLoops(self, log=False):
+    def findLoops(self, log=False, probe=None):
         """Check the runs structure for loops. 
 
         Returns False if it's possible to get stuck in a loop'
@@ -293,56 +637,130 @@ class Track():
 
         It may be possible to have higher order loops, let's cover this later
 
+        probe, an instrument.Probe, gets the number of roots started from
+        (chains), hops, and why the search stopped.
 
         """
 
+        if probe is not None:
+            started = probe.start()
+        trace = probe is not None and probe.trace
+        hops = 0
+
         # find all first order loops explicitly
-        foundLoop = False
-        for j in self.junctions.keys():  # starting from each junction's root node
+        names = self.junctionNames
+        table = self.portTable.tolist()
+        nJunctions = len(names)
+        for j in range(nJunctions):  # starting from each junction's root node
             if log:
-                print(f'Starting at junction {j}.root')
+                print(f'Starting at junction {names[j]}.root')
             next_junction = j
             loop_length = 0
             while True:
                 # find where you end up when you exit this node
-                # do this by scanning the runs structure for j.root,
-                # and naming the end port
+                # by looking up next_junction.root in the port table
                 if log:
-                    print(f'Scanning the runs structure for {next_junction}.root')
-                for r in self.runs:
-                    skipFlag = False
-                    if log:
-                        print(f'current run is {r}')
-                    if r.start_junction.name == next_junction and r.start_port == "root":
-                        if log:
-                            print(f'found {next_junction}.root at the start')
-                        next_junction = r.end_junction
-                        # if by exiting this port we hit a root node, we
-                        # have a decision to make, so a journey leaving this
-                        # junction in this direction is not part of a loop
-                        if r.end_port == "root":
-                            skipFlag = True
-                        # whether we end up going into the left or right node
-                        # of the next junction is immaterial, both converge at
-                        # the root of the next junction.
-                    # repeat the equivalent logic but the other way around
-                    elif r.end_junction.name == next_junction and r.end_port == "root":
-                        if log:
-                            print(f'found {next_junction}.root at the end')
-                        next_junction = r.start_junction
-                        if r.start_port == "root":
-                            skipFlag = True
-                print(f'next junction = {next_junction}')
+                    print(f'Looking up {names[next_junction]}.root in the port table')
+                nextPort = table[3 * next_junction + ROOT]
+                if nextPort < 0:
+                    if probe is not None:
+                        probe.finish('findLoops', started, FAILED, chains=j + 1, hops=hops)
+                    raise ValueError(f'Nothing is connected to {names[next_junction]}.root')
+                hops += 1
+                if trace:
+                    probe.hop(3 * next_junction + ROOT, nextPort)
+                next_junction, port = divmod(nextPort, 3)
+                # if by exiting this port we hit a root node, we
+                # have a decision to make, so a journey leaving this
+                # junction in this direction is not part of a loop
+                # whether we end up going into the left or right node
+                # of the next junction is immaterial, both converge at
+                # the root of the next junction.
+                skipFlag = port == ROOT
+                if log:
+                    print(f'next junction = {names[next_junction]}')
                 loop_length += 1
                 if skipFlag:
                     break  # out of the while loop, because root to root was found
-                if next_junction == j and loop_length <= len(self.junctions):
-                    print('Found a loop')
+                if next_junction == j and loop_length <= nJunctions:
+                    if log:
+                        print('Found a loop')
+                    if probe is not None:
+                        probe.finish('findLoops', started, LOOP, chains=j + 1, hops=hops)
                     return False  # we have found a loop
-                if loop_length > len(self.junctions):
+                if loop_length > nJunctions:
                     break
+        if probe is not None:
+            probe.finish('findLoops', started, NO_LOOP, chains=nJunctions, hops=hops)
         return True
 
+    def canonicalKey(self):
+        """Hash of the run structure that ignores junction names, run names
+        and left/right swaps, see verify.canonical_key"""
+        from verify import canonical_key
+        if self._canonicalKey is None:
+            self._canonicalKey = canonical_key(self.portTable)
+        return self._canonicalKey
+
+    def verdict(self, method='checkLayout', cache=None):
+        """Good/bad verdict of checkLayout or findLoops, remembered for every
+        equivalent layout in cache (verify.default_cache if None)"""
+        from verify import default_cache
+        return (cache or default_cache).verdict(self, method)
+
+    def checkLayout(self):
+        """Exact, deterministic version of self.traverse
+
+        Builds the directed graph of (junction, port, facing) states and
+        checks it is strongly connected, see topology.check_table.
+        Unlike traverse this catches higher order loops as well.
+
+        Returns (True, []) for a good layout, or (False, trap) for a bad one,
+        where trap lists the (junction name, port, 'in'|'out') states of a
+        loop the train can get into but never leave.
+        """
+        good, trap = check_table(self.portTable)
+        return good, describe_states(trap, self.junctionNames)
+
+    def repair(self, maxEdits=4, rewires=True):
+        """Fewest reversing loops and rewired runs that make the layout
+        good, see repair.repair_track
+
+        Returns (config, edits), or None if it takes more than maxEdits.
+        """
+        from repair import repair_track
+        return repair_track(self, maxEdits, rewires)
+
+    def simulate(self, nTrains, duration, **kwargs):
+        """Run nTrains trains on the layout at once for duration, see
+        simulate.Simulation for the options. Runs are as long as their
+        curves if the geometry has been built, otherwise all length 1.
+
+        Returns a simulate.SimulationReport.
+        """
+        from simulate import Simulation
+        lengths = None
+        if self._junctions is not None:
+            lengths = [0.0] * len(self.portTable)
+            for (p, q), length in zip(self.geometry.runPorts.tolist(), self.geometry.runLengths().tolist()):
+                lengths[p] = lengths[q] = length
+        return Simulation(self.portTable, nTrains, lengths, junctionNames=self.junctionNames,
+                          **kwargs).run(duration)
+
+    def witnessTour(self, start=None):
+        """A journey covering every run in both directions and ending where
+        it started, for a good layout, see tour.witness_tour
+
+        Returns a list of (junction name, entry port, exit port, switch
+        setting) steps. tour.witness_tour(self.portTable) gives the same
+        tour as a compact integer array.
+        """
+        from tour import describe_tour, witness_tour
+        if isinstance(start, str):
+            name, port = parse_end(start)
+            start = 3 * self.junctionIds[name] + port
+        return describe_tour(witness_tour(self.portTable, start), self.junctionNames)
+
 
 class Run():
     # a Run has a start and end point and start and end gradients
@@ -356,25 +774,42 @@ class Run():
         self.name = name
         self.color = 'b'
         self.cost = 0
+        self.artist = None  # Will be set during draw
 
-    def draw(self, ax):
-        self.calculateCurve()
-        ax.plot(self.curve[:, 0], self.curve[:, 1], self.color)
+    def draw(self, ax, recalculate=True):
+        if recalculate:
+            self.calculateCurve()
+        self.artist = ax.plot(self.curve[:, 0], self.curve[:, 1], color=self.color)[0]
 
-    def rescale(self, scale, ax):
+    def update_artist(self):
+        if self.artist:
+            self.artist.set_data(self.curve[:, 0], self.curve[:, 1])
+            self.artist.set_color(self.color)
+
+    def rescale(self, scale):
         self.scale = scale
-        self.draw(ax)
 
-    def calculateCurve(self):
+    def controlPoints(self):
+        """(4, 2) control points of the run's Bezier curve"""
         start = self.start_junction.endpoints[self.start_port]
         end = self.end_junction.endpoints[self.end_port]
         startGradient = self.start_junction.gradients[self.start_port]
         endGradient = self.end_junction.gradients[self.end_port]
+        return np.array([start,
+                         start + startGradient * self.scale,
+                         end + endGradient * self.scale,
+                         end])
+
+    def calculateCurve(self):
+        self.curve = bezier_cubic(*self.controlPoints())
 
-        self.curve = bezier_cubic(start,
-                                  start + startGradient * self.scale,
-                                  end + endGradient * self.scale,
-                                  end)
+    def length(self):
+        """Arc length of the run, see geometry.bezier_lengths"""
+        return float(bezier_lengths(self.controlPoints()[None])[0])
+
+    def curvature(self, t):
+        """Signed curvature of the run at t (0 to 1 along it)"""
+        return bezier_curvature(self.controlPoints()[None], t)[0]
 
     def __repr__(self):
         return f"{self.start_junction.name}.{self.start_port} --> {self.end_junction.name}.{self.end_port}"
@@ -383,7 +818,13 @@ class Run():
 class Junction():
     # a junction has coordinates that define its root
     # and an angle that defines which direction it goes in
-    def __init__(self, loc, direction, name):
+    # the numbers themselves live in a JunctionStore, shared by all
+    # the junctions of a track, this is just a view of one row of it
+    __slots__ = ('store', 'index', 'name', 'color', 'endpoints', 'gradients',
+                 'leftCurve', 'rightCurve', 'nub_artist', 'rot_artist', 'swap_artist',
+                 'left_artist', 'right_artist', 'text_artist')
+
+    def __init__(self, loc, direction, name, store=None, index=0):
         """
         Parameters
         ----------
@@ -391,39 +832,94 @@ class Junction():
             location of root
         direction : scalar float in degrees
             direction that the midpoint of the junction points
+        store : JunctionStore or None
+            store holding this junction's geometry, a new one is made
+            if not given. If loc is None the junction just takes over
+            row index of the store as it is.
+        index : int
+            row of the store for this junction
         """
-        self.loc = loc
-        self.direction = direction
-        self.scale = 0.5
+        if store is None:
+            store = JunctionStore(1)
+            index = 0
+        self.store = store
+        self.index = index
         self.color = 'r'
         self.name = name
-        self.swapped = 1  # or -1
-        self.endpoints = {}
-        self.gradients = {}
-        self.get_points()
+        self.endpoints = PortArrays(store.endpoints, index)
+        self.gradients = PortArrays(store.gradients, index)
+        if loc is not None:
+            store.loc[index] = loc
+            store.direction[index] = direction
+            self.get_points()
         self.nub_artist = None  # Will be set during draw
         self.rot_artist = None
         self.swap_artist = None
+        self.left_artist = None
+        self.right_artist = None
+        self.text_artist = None
+
+    @property
+    def loc(self):
+        return self.store.loc[self.index]
+
+    @loc.setter
+    def loc(self, value):
+        self.store.loc[self.index] = value
+
+    @property
+    def direction(self):
+        return self.store.direction[self.index]
+
+    @direction.setter
+    def direction(self, value):
+        self.store.direction[self.index] = value
+
+    @property
+    def swapped(self):
+        return self.store.swapped[self.index]
+
+    @swapped.setter
+    def swapped(self, value):
+        self.store.swapped[self.index] = value
+
+    @property
+    def scale(self):
+        return self.store.scale[self.index]
+
+    @scale.setter
+    def scale(self, value):
+        self.store.scale[self.index] = value
+
+    @property
+    def r(self):
+        return self.store.rot[self.index]
+
+    @property
+    def leftEndpoint(self):
+        return self.endpoints['left']
+
+    @property
+    def rightEndpoint(self):
+        return self.endpoints['right']
+
+    @property
+    def startGradient(self):
+        return self.gradients['root']  # note the start gradient is pointing away from the root
+
+    @property
+    def leftGradient(self):
+        return self.gradients['left']
+
+    @property
+    def rightGradient(self):
+        return self.gradients['right']
 
     def get_points(self):
-        self.r = rotation_matrix(self.direction)
-        self.leftEndpoint = self.loc + np.array([self.swapped * -0.5, 1]) @ self.r
-        self.rightEndpoint = self.loc + np.array([self.swapped * 0.5, 1]) @ self.r
-        self.startGradient = np.array([0, -0.707]) @ self.r  # note the start gradient is pointing away from the root
-        self.leftGradient = np.array([self.swapped * -0.5, 0.5]) @ self.r
-        self.rightGradient = np.array([self.swapped * 0.5, 0.5]) @ self.r
-        self.endpoints['left'] = self.leftEndpoint
-        self.endpoints['right'] = self.rightEndpoint
-        self.endpoints['root'] = self.loc
-        self.gradients['left'] = self.leftGradient
-        self.gradients['right'] = self.rightGradient
-        self.gradients['root'] = self.startGradient
+        self.store.update(self.index)
 
     def update_position(self, new_pos):
         self.loc = new_pos
-        if self.nub_artist:
-            dx, dy = [0, 0.5] @ self.r
-            self.nub_artist.set_data(new_pos[0] + dx, new_pos[1] + dy)
         self.get_points()
 
     def update_rotation(self, new_direction):
@@ -447,10 +943,11 @@ class Junction():
                                        self.rightEndpoint - self.rightGradient * self.scale,
                                        self.rightEndpoint)
 
-    def draw(self, ax):
-        self.calculateCurves()
-        ax.plot(self.leftCurve[:, 0], self.leftCurve[:, 1], self.color)
-        ax.plot(self.rightCurve[:, 0], self.rightCurve[:, 1], self.color, linestyle='--')
+    def draw(self, ax, recalculate=True):
+        if recalculate:
+            self.calculateCurves()
+        self.left_artist = ax.plot(self.leftCurve[:, 0], self.leftCurve[:, 1], self.color)[0]
+        self.right_artist = ax.plot(self.rightCurve[:, 0], self.rightCurve[:, 1], self.color, linestyle='--')[0]
 
         # plot nub
         x, y = self.loc
@@ -458,13 +955,31 @@ class Junction():
         self.nub_artist = ax.plot(x + dx, y + dy, 'bo', markersize=10, picker=True)[0]
         self.rot_artist = ax.plot(x + 1.3 * dx, y + 1.3 * dy, 'ko', markersize=7, picker=True)[0]
         self.swap_artist = ax.plot(x + 0.7 * dx, y + 0.7 * dy, 'ms', markersize=7, picker=True)[0]
-        ax.text(*self.loc, self.name)
+        self.text_artist = ax.text(*self.loc, self.name)
+
+    def update_artists(self):
+        """Move the artists made by draw() to match the current curves"""
+        if not self.nub_artist:
+            return
+        self.left_artist.set_data(self.leftCurve[:, 0], self.leftCurve[:, 1])
+        self.right_artist.set_data(self.rightCurve[:, 0], self.rightCurve[:, 1])
+        x, y = self.loc
+        dx, dy = [0, 0.5] @ self.r
+        self.nub_artist.set_data([x + dx], [y + dy])
+        self.rot_artist.set_data([x + 1.3 * dx], [y + 1.3 * dy])
+        self.swap_artist.set_data([x + 0.7 * dx], [y + 0.7 * dy])
+        self.text_artist.set_position(self.loc)
+
+    def artists(self):
+        return [self.left_artist, self.right_artist, self.nub_artist,
+                self.rot_artist, self.swap_artist, self.text_artist]
 
     def __repr__(self):
         return self.name
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
 
     plt.close('all')
 
@@ -536,4 +1051,5 @@ if __name__ == "__main__":
     T = Track(config)
     # print(T.findLoops())
     # print(T.traverse())
+    print(T.checkLayout())
     T.draw()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Topology of a layout, independent of any geometry.
+
+Every junction has three ports (root, left, right). Ports are numbered
+3 * junction_id + port, so a whole layout fits in one integer array,
+the port table, where table[p] is the port at the other end of the run
+that leaves port p (or -1 if nothing is connected to p).
+
+@author: Dan
+"""
+
+import numpy as np
+
+ROOT, LEFT, RIGHT = 0, 1, 2
+PORT_NAMES = ('root', 'left', 'right')
+PORT_INDEX = {name: i for i, name in enumerate(PORT_NAMES)}
+
+
+def parse_end(end):
+    """Split "<junction name>.<left|right|root>" into (name, port index)"""
+    junctionName, portName = end.split('.')
+    if portName not in PORT_INDEX:
+        raise ValueError(f'Unknown port "{portName}" in "{end}"')
+    return junctionName, PORT_INDEX[portName]
+
+
+def build_port_table(config):
+    """Build the port table for a run config
+
+    Parameters
+    ----------
+    config : dict
+        {"name of run": ["<junction name>.<left|right|root>",
+                         "<junction name>.<left|right|root>"]}
+
+    Returns
+    -------
+    junctionNames : list of str
+        junction names, in order of first appearance in the config,
+        so junctionNames[i] is the name of junction id i
+    table : np.array of int32, shape (3 * number of junctions,)
+        table[3 * j + port] = the port at the other end of the run
+    """
+    junctionNames = []
+    junctionIds = {}
+    pairs = []
+    for k, v in config.items():  # for each run
+        ends = []
+        for end in v:  # for each connection termination
+            junctionName, port = parse_end(end)
+            if junctionName not in junctionIds:
+                junctionIds[junctionName] = len(junctionNames)
+                junctionNames.append(junctionName)
+            ends.append(3 * junctionIds[junctionName] + port)
+        pairs.append(ends)
+
+    table = np.full(3 * len(junctionNames), -1, dtype=np.int32)
+    for (k, v), (a, b) in zip(config.items(), pairs):
+        for p in (a, b):
+            if table[p] != -1:
+                raise ValueError(f'Run {k} uses a port that is already connected: {v}')
+        if a == b:
+            raise ValueError(f'Run {k} connects a port to itself: {v}')
+        table[a] = b
+        table[b] = a
+    return junctionNames, table
+
+
+# A train on the layout is always at a port, either heading into the junction
+# (IN) or heading out of it along a run (OUT). State id = 2 * port + facing.
+IN, OUT = 0, 1
+FACING_NAMES = ('in', 'out')
+
+
+def state_successors(table):
+    """Directed graph of (junction, port, facing) states for a port table
+
+    Entering a junction at its root the train can leave by left or right,
+    entering at left or right it must leave by the root. Leaving by a port
+    it follows the run and enters the junction at the other end.
+
+    Returns a list where entry s is a tuple of the states reachable from s
+    in one move. A port with nothing connected to it is a dead end.
+    """
+    succ = []
+    for p, q in enumerate(np.asarray(table).tolist()):
+        j, port = divmod(p, 3)
+        # state 2 * p: heading into junction j at port p
+        if port == ROOT:
+            succ.append((2 * (3 * j + LEFT) + OUT, 2 * (3 * j + RIGHT) + OUT))
+        else:
+            succ.append((2 * (3 * j + ROOT) + OUT,))
+        # state 2 * p + 1: leaving junction j at port p
+        succ.append((2 * q + IN,) if q >= 0 else ())
+    return succ
+
+
+def strongly_connected_components(succ):
+    """Tarjan's algorithm, iterative so big layouts don't hit the recursion limit
+
+    Yields the strongly connected components of the graph as lists of states,
+    in reverse topological order, so the first component yielded is always
+    a sink: once a train is in it, it can never get out.
+    """
+    nStates = len(succ)
+    index = [-1] * nStates
+    low = [0] * nStates
+    onStack = [False] * nStates
+    stack = []
+    counter = 0
+    for start in range(nStates):
+        if index[start] != -1:
+            continue
+        index[start] = low[start] = counter
+        counter += 1
+        stack.append(start)
+        onStack[start] = True
+        work = [(start, 0)]
+        while work:
+            v, i = work[-1]
+            if i < len(succ[v]):
+                work[-1] = (v, i + 1)
+                w = succ[v][i]
+                if index[w] == -1:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    onStack[w] = True
+                    work.append((w, 0))
+                elif onStack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    if low[v] < low[u]:
+                        low[u] = low[v]
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        onStack[w] = False
+                        component.append(w)
+                        if w == v:
+                            break
+                    yield component
+
+
+def check_table(table):
+    """Decide whether a layout is good, exactly, in O(number of junctions)
+
+    A layout is good when a train starting anywhere, facing either way, can
+    cover every run in both directions and get back to where it started
+    facing the same way. That is the case exactly when the state graph is
+    strongly connected.
+
+    Returns
+    -------
+    good : bool
+    trap : list of int
+        empty if the layout is good, otherwise the states of a strongly
+        connected component that a train can enter but never leave
+    """
+    succ = state_successors(table)
+    if not succ:
+        return False, []
+    # the first component Tarjan finishes is a sink, if it isn't the whole
+    # graph then the layout is bad and there's no need to look any further
+    trap = next(strongly_connected_components(succ))
+    if len(trap) == len(succ):
+        return True, []
+    return False, sorted(trap)
+
+
+def is_good(table):
+    """True if the layout with this port table is good, see check_table"""
+    return check_table(table)[0]
+
+
+def describe_states(states, junctionNames):
+    """Turn state ids into readable (junction name, port, facing) tuples"""
+    described = []
+    for s in states:
+        j, port = divmod(s // 2, 3)
+        described.append((junctionNames[j], PORT_NAMES[port], FACING_NAMES[s % 2]))
+    return described
+
+
+def run_name(i):
+    """Spreadsheet style run names: A, B, ..., Z, AA, AB, ..."""
+    name = ''
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        name = chr(ord('A') + r) + name
+    return name
+
+
+def table_to_config(table, junctionNames=None):
+    """Turn a port table back into a run config that Track accepts
+
+    Junctions are called j1, j2, ... unless junctionNames is given, runs are
+    named A, B, C, ... in order of their lowest numbered port.
+    """
+    table = np.asarray(table).tolist()
+    if junctionNames is None:
+        junctionNames = [f'j{i + 1}' for i in range(len(table) // 3)]
+    config = {}
+    for p, q in enumerate(table):
+        if p < q:
+            ends = []
+            for port in (p, q):
+                j, k = divmod(port, 3)
+                ends.append(f'{junctionNames[j]}.{PORT_NAMES[k]}')
+            config[run_name(len(config))] = ends
+    return config
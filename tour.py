@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+An explicit journey over a good layout that covers every run in both
+directions and gets back to where it started, facing the same way.
+
+The tour is a closed walk in the state graph (see topology.state_successors)
+that uses every move at least once. The state graph isn't Eulerian as it
+stands: entering a junction at its root there are two ways out, but only
+one way in, and leaving by the root it's the other way round. So each
+junction has one state short of an outgoing move and one short of an
+incoming move. Those are evened up by sending an extra trip from every
+state with too many incoming moves to the nearest state still short of
+one, found by a breadth first search from it, so the extra trips are only
+as long as the layout makes them. Some layouts need long ones: a train
+entering a string of junctions root first, each from a branch of the one
+before, has to come back through the first one once for every junction
+after it. Every move then has as many trips in as out, and Hierholzer's
+algorithm strings them into one closed walk, in time linear in the length
+of the walk, with no retries.
+
+@author: Dan
+"""
+
+from collections import deque
+
+import numpy as np
+
+from topology import ROOT, PORT_NAMES, IN, check_table, state_successors
+
+
+def witness_tour(table, start=None):
+    """Closed walk over a good layout covering every run in both directions
+
+    Parameters
+    ----------
+    table : port table
+    start : int or None
+        port to start at, heading into its junction, by default the root of
+        junction 0
+
+    Returns
+    -------
+    np.array of int32, shape (steps, 3)
+        one row per pass through a junction: junction id, the port the
+        train enters by and the port it leaves by. Row k + 1 starts at the
+        far end of the run leaving row k, and the last row leads back to
+        the first. The switch at each junction has to be set to whichever
+        of the two ports isn't the root.
+    """
+    good, trap = check_table(table)
+    if not good:
+        raise ValueError(f'No tour exists, a train can get stuck in {trap}')
+    if start is None:
+        start = ROOT
+    succ = state_successors(table)
+    nStates = len(succ)
+
+    # every move once, then the extra trips that balance the graph
+    arcStart = [s for s in range(nStates) for t in succ[s]]
+    arcEnd = [t for s in range(nStates) for t in succ[s]]
+    trips = [1] * len(arcEnd)
+    firstArc = [0] * (nStates + 1)
+    for s in range(nStates):
+        firstArc[s + 1] = firstArc[s] + len(succ[s])
+    balance = [0] * nStates  # trips in - trips out
+    for s, t in zip(arcStart, arcEnd):
+        balance[s] -= 1
+        balance[t] += 1
+
+    # an extra trip from each state with a surplus to the nearest one short
+    parentArc = [-1] * nStates
+    searched = [-1] * nStates  # the last search to reach each state
+    search = 0
+    for s in range(nStates):
+        while balance[s] > 0:
+            searched[s] = search
+            queue = deque([s])
+            while balance[queue[0]] >= 0:
+                v = queue.popleft()
+                for a in range(firstArc[v], firstArc[v + 1]):
+                    w = arcEnd[a]
+                    if searched[w] != search:
+                        searched[w] = search
+                        parentArc[w] = a
+                        queue.append(w)
+            w = queue[0]
+            balance[s] -= 1
+            balance[w] += 1
+            while w != s:
+                a = parentArc[w]
+                trips[a] += 1
+                w = arcStart[a]
+            search += 1
+
+    # Hierholzer
+    nextArc = firstArc[:-1]
+    stack = [2 * start + IN]
+    walk = []
+    while stack:
+        v = stack[-1]
+        a = nextArc[v]
+        while a < firstArc[v + 1] and trips[a] == 0:
+            a += 1
+        nextArc[v] = a
+        if a < firstArc[v + 1]:
+            trips[a] -= 1
+            stack.append(arcEnd[a])
+        else:
+            walk.append(stack.pop())
+    walk.reverse()
+
+    # the walk alternates IN and OUT states starting from an IN state, so
+    # each (IN, OUT) pair is a pass through a junction
+    ports = np.asarray(walk[:-1], dtype=np.int32) // 2
+    entry = ports[0::2]
+    exit = ports[1::2]
+    return np.stack([entry // 3, entry % 3, exit % 3], axis=1).astype(np.int32)
+
+
+def switch_settings(tour):
+    """The branch (LEFT or RIGHT) each junction's switch is set to at each
+    step of a tour"""
+    tour = np.asarray(tour)
+    return np.where(tour[:, 1] == ROOT, tour[:, 2], tour[:, 1])
+
+
+def describe_tour(tour, junctionNames):
+    """Turn a tour into readable (junction name, entry port, exit port,
+    switch setting) tuples"""
+    return [(junctionNames[j], PORT_NAMES[a], PORT_NAMES[b], PORT_NAMES[s])
+            for (j, a, b), s in zip(np.asarray(tour).tolist(), switch_settings(tour).tolist())]
+
+
+if __name__ == "__main__":
+    from repair import add_reversing_loop
+
+    # a long chain of reversing loops, each spliced in facing the root of the
+    # last one, can be toured in a few steps per junction
+    table = [3, 2, 1, 0, 5, 4]
+    for k in range(400):
+        table = add_reversing_loop(table, len(table) - 3)
+    tour = witness_tour(table)
+    nJunctions = len(table) // 3
+    print(f'{nJunctions} junctions: {len(tour)} steps')
+    assert len(tour) <= 8 * nJunctions, 'tour should grow with the number of ports'
+    # every move used, and each step leading on to the next
+    ports = 3 * tour[:, :1] + tour[:, 1:]
+    assert len({tuple(p) for p in ports.tolist()}) == sum(2 if p % 3 == ROOT else 1 for p in range(len(table)))
+    assert (np.asarray(table)[ports[:, 1]] == np.roll(ports[:, 0], -1)).all()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Checking lots of layouts at once.
+
+Only the topology of each layout is used, so no Junction/Run objects or
+geometry get built. The work is spread over a process pool in chunks.
+
+@author: Dan
+"""
+
+import hashlib
+import os
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from enumeration import canonical_table
+from topology import build_port_table, is_good
+
+
+def verify_config(config):
+    """True if the layout described by a run config is good"""
+    junctionNames, table = build_port_table(config)
+    return is_good(table)
+
+
+def _verify_chunk(configs):
+    return [verify_config(c) for c in configs]
+
+
+def _verify_table_chunk(tables):
+    return [is_good(t) for t in tables]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def verify_many(configs, workers=None, chunksize=1000):
+    """Check an iterable of run configs, yielding True/False for each in order
+
+    Parameters
+    ----------
+    configs : iterable of dict
+        run configs, in the same format Track accepts. Can be a generator,
+        it is only read a few chunks ahead of the results.
+    workers : int or None
+        number of worker processes, None for one per CPU, 1 to check
+        everything in this process
+    chunksize : int
+        number of configs sent to a worker at a time
+    """
+    return map_chunks(_verify_chunk, configs, workers, chunksize)
+
+
+def verify_tables(tables, workers=None, chunksize=1000):
+    """Check an iterable of port tables, yielding True/False for each in
+    order, like verify_many. Works with layoutfile.read_tables to check a
+    layout file too big to fit in memory."""
+    return map_chunks(_verify_table_chunk, tables, workers, chunksize)
+
+
+def map_chunks(function, items, workers=None, chunksize=1000):
+    """Apply function to chunks of chunksize items over a process pool,
+    yielding its results in order, function takes a list of items and
+    returns a list of results. See verify_many for the arguments."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = _chunks(items, chunksize)
+
+    if workers == 1:
+        for chunk in chunks:
+            yield from function(chunk)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # keep a couple of chunks queued per worker so nobody sits idle,
+        # without pulling the whole (possibly huge) input into memory
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(function, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def canonical_key(table):
+    """Hash of the canonical form of a port table, the same for every
+    layout that only differs by junction names, run names or swaps (nearly
+    always, for layouts with more than enumeration.EXACT_JUNCTIONS
+    junctions, see enumeration.canonical_table)"""
+    table = np.asarray(table, dtype=np.int32)
+    if (table < 0).any():
+        # ports left unconnected have no canonical form, so the table is
+        # hashed as it is and only matches itself
+        return 'partial-' + hashlib.blake2b(table.tobytes(), digest_size=16).hexdigest()
+    return hashlib.blake2b(canonical_table(table).tobytes(), digest_size=16).hexdigest()
+
+
+# Track methods whose verdicts can be cached, traverse is a random walk so
+# its verdict isn't a property of the layout
+CACHED_METHODS = ('checkLayout', 'findLoops')
+
+
+class VerdictCache():
+    # good/bad verdicts keyed by canonical topology and the method that
+    # produced them, in a bounded LRU cache in memory, optionally backed by
+    # an sqlite file that any number of processes can share
+
+    def __init__(self, maxsize=100000, path=None):
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, timeout=30)
+            self.db.execute('CREATE TABLE IF NOT EXISTS verdicts '
+                            '(key TEXT, method TEXT, good INTEGER, PRIMARY KEY (key, method))')
+            self.db.commit()
+
+    def get(self, key, method):
+        """The cached verdict, or None if there isn't one"""
+        good = self.memory.get((key, method))
+        if good is not None:
+            self.memory.move_to_end((key, method))
+            return good
+        if self.db is not None:
+            row = self.db.execute('SELECT good FROM verdicts WHERE key = ? AND method = ?',
+                                  (key, method)).fetchone()
+            if row is not None:
+                good = bool(row[0])
+                self._remember(key, method, good)
+                return good
+        return None
+
+    def put(self, key, method, good):
+        self._remember(key, method, good)
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)', (key, method, int(good)))
+            self.db.commit()
+
+    def _remember(self, key, method, good):
+        self.memory[(key, method)] = good
+        self.memory.move_to_end((key, method))
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def verdict(self, track, method='checkLayout'):
+        """Verdict of track.<method>() (checkLayout or findLoops), worked out
+        only if an equivalent layout hasn't been checked before"""
+        if method not in CACHED_METHODS:
+            raise ValueError(f'Only the verdicts of {", ".join(CACHED_METHODS)} can be cached, not {method}')
+        key = track.canonicalKey()
+        good = self.get(key, method)
+        if good is not None:
+            self.hits += 1
+            return good
+        self.misses += 1
+        result = getattr(track, method)()
+        good = bool(result[0] if isinstance(result, tuple) else result)
+        self.put(key, method, good)
+        return good
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+default_cache = VerdictCache()